@@ -1,121 +1,1724 @@
-import firebase_admin
-from firebase_admin import credentials, db
+import atexit
+import gzip
 import json
+import multiprocessing
+import os
+import queue
+import random
+import sqlite3
+import struct
 import time
 import threading
-import serial
-import modbus_tk
-import modbus_tk.defines as cst
-from modbus_tk import modbus_rtu
-from gpiozero import LED
-from datetime import datetime
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque, namedtuple
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from types import MappingProxyType
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import shared_memory
 
+# The hardware and cloud libraries are only needed on the Pi. Off-Pi the
+# simulation package stands in for the meter bus, the relays and Firebase.
+try:
+    import firebase_admin
+    from firebase_admin import credentials, db
+    from firebase_admin.exceptions import UnavailableError as FirebaseUnavailableError
+except ImportError:
+    firebase_admin = credentials = db = None
+    class FirebaseUnavailableError(Exception):
+        pass
+try:
+    import serial
+    from serial import SerialException
+except ImportError:
+    serial = None
+    class SerialException(OSError):
+        pass
+try:
+    import modbus_tk.defines as cst
+    from modbus_tk import modbus_rtu
+    from modbus_tk.exceptions import ModbusInvalidResponseError
+    from modbus_tk.hooks import install_hook
+    READ_INPUT_REGISTERS = cst.READ_INPUT_REGISTERS
+except ImportError:
+    cst = modbus_rtu = install_hook = None
+    READ_INPUT_REGISTERS = 4
+    class ModbusInvalidResponseError(Exception):
+        pass
+try:
+    from gpiozero import LED
+except ImportError:
+    LED = None
 
-switch = LED(17)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# PowerConsumption keys, as written by the metering loop and stored in Firebase
+TIMESTAMP_FORMAT = '%m-%d-%Y %H:%M:%S'
+
+def timestamp_to_epoch(timestamp):
+    return datetime.strptime(timestamp, TIMESTAMP_FORMAT).timestamp()
+
+def epoch_to_timestamp(epoch):
+    return datetime.fromtimestamp(epoch).strftime(TIMESTAMP_FORMAT)
+
+class SystemClock:
+    # Wall and monotonic time for the control loops, the simulator swaps in an
+    # accelerated clock so the controller can run at N x real time
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, condition, seconds=None):
+        # condition.wait() (or an Event's) for seconds of this clock's time, None waits for a notify
+        return condition.wait(seconds)
+
+SYSTEM_CLOCK = SystemClock()
+
+# Histogram bucket upper bounds in seconds, from an in-memory update to a stalled Firebase request
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{str(value)}"' for key, value in labels) + '}'
+
+class MetricFamily:
+    # A Prometheus counter or gauge, one value per label set
+    def __init__(self, name, help_text, kind='counter'):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+    def render(self):
+        with self.lock:
+            values = list(self.values.items())
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in values:
+            lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+class Histogram:
+    # A Prometheus histogram. observe() only bumps one bucket and the sum under a
+    # short lock, the cumulative counts are built when the endpoint is scraped.
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                # One count per bucket, one for +Inf, then the sum
+                series = self.series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        with self.lock:
+            series = [(key, list(values)) for key, values in self.series.items()]
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {values[-1]}")
+            lines.append(f"{self.name}_count{format_labels(key)} {cumulative}")
+        return lines
+
+class Metrics:
+    # Registry of every metric, served in the Prometheus text format on
+    # http://127.0.0.1:<port>/metrics by serve()
+    def __init__(self):
+        self.families = []
+        self.server = None
+
+    def counter(self, name, help_text):
+        return self.register(MetricFamily(name, help_text, 'counter'))
+
+    def gauge(self, name, help_text):
+        return self.register(MetricFamily(name, help_text, 'gauge'))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help_text, buckets))
+
+    def register(self, family):
+        self.families.append(family)
+        return family
+
+    def render(self):
+        lines = []
+        for family in self.families:
+            lines.extend(family.render())
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=9101, host='127.0.0.1'):
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        except OSError as e:
+            print("Metrics Endpoint Error: ", e)
+            return None
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+METRICS = Metrics()
+LOOP_SECONDS = METRICS.histogram('ipecs_loop_seconds', 'Duration of one iteration of the meter and Firebase loops')
+MODBUS_SECONDS = METRICS.histogram('ipecs_modbus_execute_seconds', 'Modbus RTU request round-trip time')
+MODBUS_ERRORS = METRICS.counter('ipecs_modbus_errors_total', 'Failed Modbus RTU requests')
+SERIAL_REOPENS = METRICS.counter('ipecs_serial_reopens_total', 'Serial ports reopened after a fault or corrupt frames')
+FIREBASE_SECONDS = METRICS.histogram('ipecs_firebase_request_seconds', 'Firebase get and update latency')
+FIREBASE_FAILURES = METRICS.counter('ipecs_firebase_failures_total', 'Failed Firebase get and update requests')
+FIREBASE_SKIPPED = METRICS.counter('ipecs_firebase_skipped_total', 'Firebase requests not attempted while offline or the circuit breaker is open')
+FIREBASE_CONNECTED = METRICS.gauge('ipecs_firebase_connected', 'Firebase connection state, 1 when requests are let through')
+PIPELINE_DEPTH = METRICS.gauge('ipecs_pipeline_queue_depth', 'Readings waiting between acquisition and billing')
+PIPELINE_DROPPED = METRICS.counter('ipecs_pipeline_dropped_total', 'Readings dropped because the billing stage fell a full queue behind')
+PIPELINE_BACKPRESSURE = METRICS.counter('ipecs_pipeline_backpressure_total', 'Polls slowed to the idle interval because the queue was over its high water mark')
+PIPELINE_QUEUE_SECONDS = METRICS.histogram('ipecs_pipeline_queue_seconds', 'Time a reading waits between acquisition and billing')
+PIPELINE_BATCH_SIZE = METRICS.histogram('ipecs_pipeline_batch_readings', 'Readings billed per batch', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+TIME_TO_FIRST_SAMPLE = METRICS.gauge('ipecs_time_to_first_sample_seconds', 'Seconds from controller start to the first recorded meter reading')
+LOCAL_BYTES_WRITTEN = METRICS.counter('ipecs_local_bytes_written_total', 'Bytes written to local storage files')
+SAMPLES_RECORDED = METRICS.counter('ipecs_samples_recorded_total', 'PowerConsumption samples recorded, write amplification is bytes written over this')
+LOCK_WAIT_SECONDS = METRICS.histogram('ipecs_lock_wait_seconds', 'Time spent waiting to acquire a room lock')
+RELAY_CHANGES = METRICS.counter('ipecs_relay_changes_total', 'Relay state changes')
+RELAY_STATE = METRICS.gauge('ipecs_relay_on', 'Relay state, 1 when the room is powered')
+CUTOFF_LATENESS_SECONDS = METRICS.histogram('ipecs_cutoff_lateness_seconds', 'Delay between the predicted credit exhaustion and the relay cutoff')
+SAMPLES_COALESCED = METRICS.counter('ipecs_samples_coalesced_total', 'Readings merged into a flat run instead of stored as their own sample')
+STATE_COMMAND_SECONDS = METRICS.histogram('ipecs_state_command_seconds', 'Time from queueing a room state command to its snapshot being published')
+CREDIT_CRITICAL_EVENTS = METRICS.counter('ipecs_credit_critical_events_total', 'CreditCriticalLevel crossings')
+
+class TimedLock:
+    # A threading.Lock that records how long every acquire waited in LOCK_WAIT_SECONDS
+    def __init__(self, **labels):
+        self.lock = threading.Lock()
+        self.labels = labels
+
+    def acquire(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        LOCK_WAIT_SECONDS.observe(time.perf_counter() - start, **self.labels)
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+def atomic_write(path, payload, kind='json'):
+    # Write to a temp file, fsync it, then rename over path: a power cut leaves
+    # either the old or the new file, never a truncated one.
+    # kind labels the bytes in LOCAL_BYTES_WRITTEN.
+    LOCAL_BYTES_WRITTEN.inc(len(payload), kind=kind)
+    temp_file = path + '.tmp'
+    with open(temp_file, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, path)
+    try:
+        directory = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+    except OSError:
+        pass
+
+class CircuitBreaker:
+    # Stops calling a dependency that keeps failing. After failure_threshold failures
+    # in a row the breaker opens and calls are refused without trying, for a delay
+    # that doubles every time it reopens, from base_delay up to max_delay, with half
+    # of it random jitter so many controllers don't retry in lockstep. Once the delay
+    # has passed calls go through again, a success closes the breaker, a failure
+    # reopens it.
+    def __init__(self, failure_threshold=3, base_delay=1, max_delay=300, clock=SYSTEM_CLOCK):
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.failures = 0
+        self.openings = 0
+        self.retry_at = None
+        self.lock = threading.Lock()
+
+    def backoff_delay(self, attempt):
+        delay = min(self.base_delay * 2 ** attempt, self.max_delay)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def allow(self):
+        return self.retry_at is None or self.clock.monotonic() >= self.retry_at
+
+    def retry_in(self):
+        return 0 if self.retry_at is None else max(self.retry_at - self.clock.monotonic(), 0)
+
+    def record_success(self):
+        # Returns True when this closed an open breaker
+        with self.lock:
+            reopened = self.retry_at is not None
+            self.failures = 0
+            self.openings = 0
+            self.retry_at = None
+            return reopened
+
+    def record_failure(self):
+        # Returns True when this opened the breaker, concurrent failures of calls let
+        # through before it opened don't extend the delay
+        with self.lock:
+            self.failures += 1
+            if self.failures < self.failure_threshold or not self.allow():
+                return False
+            self.retry_at = self.clock.monotonic() + self.backoff_delay(self.openings)
+            self.openings += 1
+            return True
 
 class FirebaseManager:
-    def __init__(self, cert_file, db_url):
-        self.cred = credentials.Certificate(cert_file)
+    # database is the module or object providing reference(path), the Admin SDK's db
+    # by default. The simulator passes its in-process Realtime Database stand-in.
+    # The connection is made by a background thread that retries with the breaker's
+    # backoff, so the controller meters and switches relays from local state at once.
+    # Until then, and while the breaker is open, every request returns its failure
+    # value immediately without a network call or a log line.
+    def __init__(self, cert_file, db_url, emulator_host=None, database=None, clock=SYSTEM_CLOCK, breaker=None):
+        if emulator_host is not None:
+            # The Admin SDK sends every request and listen() stream to this local
+            # stand-in server (e.g. "localhost:9000") instead of the live project
+            os.environ['FIREBASE_DATABASE_EMULATOR_HOST'] = emulator_host
+        self.cert_file = cert_file
         self.db_url = db_url
-        self.initialize_firebase()
+        self.database = database
+        self.clock = clock
+        self.breaker = breaker or CircuitBreaker(clock=clock)
+        self.connected = threading.Event()
+        self.room_refs = {}
+        self.listeners = {}
+        self.credit_etags = {}
+        self.room_etags = {}
+        FIREBASE_CONNECTED.set(0)
+        self.connect_thread = threading.Thread(target=self.run_connect, daemon=True)
+        self.connect_thread.start()
 
-    def initialize_firebase(self):
+    def initialize_firebase(self, report=True):
+        # One connection attempt: set up the app once, then read one small node to
+        # check the database is reachable. Returns True when connected.
         try:
-            firebase_admin.initialize_app(self.cred, {'databaseURL': self.db_url, 'databasePersistence': True})
-            self.RoomRef = db.reference('/Rooms/Room-1')
-        except firebase_admin.exceptions.UnavailableError:
-            print('Failed to Initialize Waiting for Internet')
-            time.sleep(1)
+            if self.database is None:
+                cred = credentials.Certificate(self.cert_file) if self.cert_file is not None else None
+                firebase_admin.initialize_app(cred, {'databaseURL': self.db_url, 'databasePersistence': True})
+                self.database = db
+            self.RoomRef = self.room_reference("Room-1")
+            self.RoomRef.child('CurrentCredit').get()
+            return True
+        except Exception as e:
+            if report:
+                print('Failed to Initialize Waiting for Internet: ', e)
+            return False
+
+    def run_connect(self):
+        # Only the first failed attempt is logged
+        attempt = 0
+        while not self.initialize_firebase(report=attempt == 0):
+            self.clock.sleep(self.breaker.backoff_delay(attempt))
+            attempt += 1
+        print('Firebase Connected')
+        self.connected.set()
+        FIREBASE_CONNECTED.set(1)
+
+    def available(self):
+        return self.connected.is_set() and self.breaker.allow()
+
+    def retry_in(self):
+        # Seconds until requests are let through again, None while still connecting
+        return self.breaker.retry_in() if self.connected.is_set() else None
 
-    def get_firebase_data(self):
+    def request_succeeded(self, op, request_start):
+        FIREBASE_SECONDS.observe(time.perf_counter() - request_start, op=op)
+        if self.breaker.record_success():
+            print('Firebase Reachable Again')
+            FIREBASE_CONNECTED.set(1)
+
+    def request_failed(self, op, message):
+        # Only failures before the breaker opens are logged, then one line per opening
+        FIREBASE_FAILURES.inc(op=op)
+        if self.breaker.record_failure():
+            print(f'{message}, Retrying in {self.breaker.retry_in():.0f} s')
+            FIREBASE_CONNECTED.set(0)
+        elif self.breaker.allow():
+            print(message)
+
+    def room_reference(self, room_id):
+        if room_id not in self.room_refs:
+            self.room_refs[room_id] = self.database.reference(f'/Rooms/{room_id}')
+        return self.room_refs[room_id]
+
+    def get_firebase_data(self, room_id="Room-1"):
+        if not self.available():
+            FIREBASE_SKIPPED.inc(op='get')
+            return None
+        request_start = time.perf_counter()
         try:
-            return self.RoomRef.get()
-        except firebase_admin.exceptions.UnavailableError:
-            print('No Internet Detected, Storing Data Locally')
+            data = self.room_reference(room_id).get()
+            self.request_succeeded('get', request_start)
+            return data
+        except FirebaseUnavailableError:
+            self.request_failed('get', 'No Internet Detected, Storing Data Locally')
             return None
-            time.sleep(1)
         except Exception as e:
-            print(f"Get Firebase Error: {e}")
+            self.request_failed('get', f"Get Firebase Error: {e}")
             return None
-            time.sleep(1)
 
-    def update_firebase_data(self, data):
+    def update_firebase_data(self, data, room_id="Room-1"):
+        # room_id None applies data's multi-path keys from the database root
+        if not self.available():
+            FIREBASE_SKIPPED.inc(op='update')
+            return False
+        request_start = time.perf_counter()
         try:
-            return self.RoomRef.update(data)
-            print("Sending data to Firebase")
-            time.sleep(1)
+            reference = self.database.reference('/') if room_id is None else self.room_reference(room_id)
+            reference.update(data)
+            self.request_succeeded('update', request_start)
+            return True
         except Exception as e:
-            print("Update Firebase Error: ", e)
-            time.sleep(1)
+            self.request_failed('update', f"Update Firebase Error: {e}")
+            return False
+
+    def get_key_range(self, path, start=None, end=None, limit=None):
+        # The children of the node at path with start <= key <= end, the first limit
+        # of them in key order. None when the request failed, {} for none.
+        if not self.available():
+            FIREBASE_SKIPPED.inc(op='query')
+            return None
+        request_start = time.perf_counter()
+        try:
+            query = self.database.reference(path).order_by_key()
+            if start is not None:
+                query = query.start_at(start)
+            if end is not None:
+                query = query.end_at(end)
+            if limit is not None:
+                query = query.limit_to_first(limit)
+            data = query.get()
+            self.request_succeeded('query', request_start)
+            return dict(data or {})
+        except Exception as e:
+            self.request_failed('query', f"Query Firebase Error: {e}")
+            return None
+
+    def deduct_credit(self, amount, room_id="Room-1", sequence=None, max_attempts=5):
+        # Takes amount off the room's CurrentCredit as a compare-and-set on the ETag
+        # of our last write, the same check transaction() makes without its initial
+        # get(): one round trip unless the app changed the balance since, then one
+        # more per change. With a sequence the compare-and-set covers the room node and
+        # records it as LedgerApplied in the same write, see deduct_batch, a room node
+        # holding more than scalar fields falls back to CurrentCredit alone.
+        # Returns (new balance, amount deducted), or None when it could not be applied.
+        if not self.available():
+            FIREBASE_SKIPPED.inc(op='deduct')
+            return None
+        request_start = time.perf_counter()
+        try:
+            if sequence is not None:
+                result = self.deduct_batch(amount, room_id, sequence, max_attempts, request_start)
+                if result is not False:
+                    return result
+            reference = self.room_reference(room_id).child('CurrentCredit')
+            if room_id in self.credit_etags:
+                etag, value = self.credit_etags[room_id]
+            else:
+                value, etag = reference.get(etag=True)
+            for _ in range(max_attempts):
+                new_value = round(max((value or 0) - amount, 0), 7)
+                success, value, etag = reference.set_if_unchanged(etag, new_value)
+                if success:
+                    self.credit_etags[room_id] = (etag, new_value)
+                    self.request_succeeded('deduct', request_start)
+                    return new_value, amount
+            # Contention, not an outage, so the breaker is left alone
+            self.credit_etags[room_id] = (etag, value)
+            FIREBASE_FAILURES.inc(op='deduct')
+            print("Deduct Credit Error: Too Many Concurrent Changes")
+        except Exception as e:
+            self.credit_etags.pop(room_id, None)
+            self.room_etags.pop(room_id, None)
+            self.request_failed('deduct', f"Deduct Credit Error: {e}")
+        return None
+
+    def deduct_batch(self, amount, room_id, sequence, max_attempts, request_start):
+        # The room node's LedgerApplied {"Sequence", "Deduction"} names the last batch
+        # taken off CurrentCredit. A retry of a batch whose write landed but whose
+        # response was lost finds its own sequence there and only reports what was
+        # deducted, so a batch is never charged twice. The write carries the whole node,
+        # so a node holding more than scalar fields and LedgerApplied, e.g. a legacy
+        # PowerConsumption history, is left alone and False returned.
+        reference = self.room_reference(room_id)
+        if room_id in self.room_etags:
+            etag, room = self.room_etags[room_id]
+        else:
+            room, etag = reference.get(etag=True)
+        for _ in range(max_attempts):
+            room = room or {}
+            if any(isinstance(value, dict) for key, value in room.items() if key != "LedgerApplied"):
+                self.room_etags.pop(room_id, None)
+                return False
+            applied = room.get("LedgerApplied") or {}
+            if applied.get("Sequence") == sequence:
+                self.room_etags[room_id] = (etag, room)
+                self.request_succeeded('deduct', request_start)
+                return room.get("CurrentCredit", 0), applied.get("Deduction", 0)
+            new_room = dict(room)
+            new_room["CurrentCredit"] = round(max((room.get("CurrentCredit") or 0) - amount, 0), 7)
+            new_room["LedgerApplied"] = {"Sequence": sequence, "Deduction": amount}
+            success, room, etag = reference.set_if_unchanged(etag, new_room)
+            if success:
+                self.room_etags[room_id] = (etag, new_room)
+                self.request_succeeded('deduct', request_start)
+                return new_room["CurrentCredit"], amount
+        self.room_etags[room_id] = (etag, room)
+        FIREBASE_FAILURES.inc(op='deduct')
+        print("Deduct Credit Error: Too Many Concurrent Changes")
+        return None
+
+    def listen_room_fields(self, fields, callback, room_id="Room-1"):
+        # One streaming listener per scalar child, so PowerConsumption is never fetched.
+        # Returns False when any could not be opened, the caller retries later.
+        self.close_listeners(room_id)
+        if not self.available():
+            FIREBASE_SKIPPED.inc(op='listen')
+            return False
+        listeners = self.listeners.setdefault(room_id, [])
+        for field in fields:
+            def handle_event(event, field=field):
+                if event.path == '/' and event.data is not None:
+                    callback(field, event.data)
+            try:
+                listeners.append(self.room_reference(room_id).child(field).listen(handle_event))
+            except Exception as e:
+                self.request_failed('listen', f"Listen Firebase Error: {e}")
+                return False
+        return True
+
+    def close_listeners(self, room_id="Room-1"):
+        for listener in self.listeners.pop(room_id, []):
+            try:
+                listener.close()
+            except Exception as e:
+                print("Close Listener Error: ", e)
+
+class PowerSeries:
+    # PowerConsumption history as two parallel typed arrays, epoch seconds and kWh,
+    # 16 bytes per sample instead of a dict entry under a 19 character string key.
+    # Samples keep arrival order, so positions double as the sync cursor. They are
+    # normally chronological and range lookups are bisects, if the clock ever steps
+    # back lookups fall back to a scan. Samples in the same second stay separate.
+    # offset counts the samples dropped by retention, positions stay global so a
+    # sync cursor taken before pruning still points at the same sample.
+    def __init__(self, timestamps=(), values=(), offset=0):
+        self.timestamps = array('d', timestamps)
+        self.values = array('d', values)
+        self.offset = offset
+        self.chronological = all(self.timestamps[index - 1] <= self.timestamps[index] for index in range(1, len(self.timestamps)))
+
+    @classmethod
+    def from_dict(cls, power_data):
+        samples = sorted((timestamp_to_epoch(key), value) for key, value in power_data.items())
+        return cls([timestamp for timestamp, _ in samples], [value for _, value in samples])
+
+    def __len__(self):
+        return self.offset + len(self.timestamps)
+
+    def local_index(self, position):
+        return None if position is None else max(position - self.offset, 0)
+
+    def append(self, timestamp, value):
+        if self.timestamps and timestamp < self.timestamps[-1]:
+            self.chronological = False
+        self.timestamps.append(timestamp)
+        self.values.append(value)
+
+    def total_between(self, start, end):
+        # Sum of the values with start <= timestamp < end
+        if self.chronological:
+            return sum(self.values[bisect_left(self.timestamps, start):bisect_left(self.timestamps, end)])
+        return sum(value for timestamp, value in zip(self.timestamps, self.values) if start <= timestamp < end)
+
+    def samples(self, start_index=0, end_index=None):
+        start_index, end_index = self.local_index(start_index), self.local_index(end_index)
+        return list(zip(self.timestamps[start_index:end_index], self.values[start_index:end_index]))
+
+    def find_position(self, timestamp, position_hint=0):
+        # Position just after the last sample at or before timestamp. Without a
+        # chronological order that needs the exact sample, or None when it is missing
+        hint = position_hint - self.offset
+        if 0 < hint <= len(self.timestamps) and self.timestamps[hint - 1] == timestamp:
+            return position_hint
+        if self.chronological:
+            return self.offset + bisect_right(self.timestamps, timestamp)
+        for index in range(len(self.timestamps) - 1, -1, -1):
+            if self.timestamps[index] == timestamp:
+                return self.offset + index + 1
+        return None
+
+    def first_position_at(self, timestamp):
+        # Position of the first sample at or after timestamp, the start without an order
+        if self.chronological:
+            return self.offset + bisect_left(self.timestamps, timestamp)
+        return self.offset
+
+    def to_firebase_dict(self, start_index=0, end_index=None):
+        # The original {"%m-%d-%Y %H:%M:%S": kWh} shape, samples sharing a second add up
+        power_data = {}
+        start_index, end_index = self.local_index(start_index), self.local_index(end_index)
+        for timestamp, value in zip(self.timestamps[start_index:end_index], self.values[start_index:end_index]):
+            key = epoch_to_timestamp(timestamp)
+            power_data[key] = round(power_data[key] + value, 7) if key in power_data else value
+        return power_data
+
+    def dropped_before(self, timestamp):
+        # A new series without the leading samples older than timestamp. The arrays
+        # are copied, so readers still holding this series keep a consistent view.
+        if self.chronological:
+            index = bisect_left(self.timestamps, timestamp)
+        else:
+            index = 0
+            while index < len(self.timestamps) and self.timestamps[index] < timestamp:
+                index += 1
+        return PowerSeries(self.timestamps[index:], self.values[index:], self.offset + index)
+
+    def memory_bytes(self):
+        return self.timestamps.itemsize * len(self.timestamps) + self.values.itemsize * len(self.values)
+
+class SampleLog:
+    # Append-only PowerConsumption log split into fixed-size segment files, so no
+    # write ever touches old history. A record is RECORD packed: epoch seconds as a
+    # double and kWh as an integer count of 1e-7 kWh, the 7 decimals every sample is
+    # rounded to. 16 bytes instead of a ~25 byte JSON line, and read back exactly
+    # instead of as 0.20389999999999991. A record torn by a power cut is cut off
+    # before the next append. Segments of the older format, one JSON [epoch seconds,
+    # kWh] per line in segment-NNNNNN.log, are still read and pruned, appends always
+    # go to a new .bin segment.
+    RECORD = struct.Struct('<dq')
+    KIND = 'sample_log'
+
+    def __init__(self, log_dir, segment_size=1024 * 1024):
+        self.log_dir = log_dir
+        self.segment_size = segment_size
+        os.makedirs(self.log_dir, exist_ok=True)
+        segments = self.list_segments()
+        self.segment_index = segments[-1] if segments else 0
+        if segments and os.path.exists(self.legacy_path(self.segment_index)):
+            self.segment_index += 1
+        self.segment_file = None
+
+    def pack(self, sample):
+        timestamp, value = sample
+        return self.RECORD.pack(timestamp, round(value * 10000000))
+
+    def unpack(self, fields):
+        timestamp, units = fields
+        return timestamp, round(units / 10000000, 7)
+
+    def segment_path(self, index):
+        return os.path.join(self.log_dir, f"segment-{index:06d}.bin")
+
+    def legacy_path(self, index):
+        return os.path.join(self.log_dir, f"segment-{index:06d}.log")
+
+    def list_segments(self):
+        indexes = set()
+        for name in os.listdir(self.log_dir):
+            if name.startswith("segment-") and name.endswith((".bin", ".log")):
+                indexes.add(int(name[len("segment-"):-len(".bin")]))
+        return sorted(indexes)
+
+    def open_segment(self):
+        path = self.segment_path(self.segment_index)
+        self.segment_file = open(path, 'ab')
+        torn = self.segment_file.tell() % self.RECORD.size
+        if torn:
+            self.segment_file.truncate(self.segment_file.tell() - torn)
+            self.segment_file.seek(0, os.SEEK_END)
+
+    def append(self, records):
+        if self.segment_file is None:
+            self.open_segment()
+        for record in records:
+            if self.segment_file.tell() + self.RECORD.size > self.segment_size and self.segment_file.tell() > 0:
+                self.segment_file.close()
+                self.segment_index += 1
+                self.open_segment()
+            self.segment_file.write(self.pack(record))
+        self.segment_file.flush()
+        LOCAL_BYTES_WRITTEN.inc(len(records) * self.RECORD.size, kind=self.KIND)
+
+    def read_segment(self, index):
+        if os.path.exists(self.legacy_path(index)):
+            with open(self.legacy_path(index), 'r') as f:
+                for line in f:
+                    try:
+                        timestamp, value = json.loads(line)
+                    except ValueError:
+                        # A power cut can leave a torn last record, skip it
+                        continue
+                    yield timestamp, value
+            return
+        with open(self.segment_path(index), 'rb') as f:
+            payload = f.read()
+        payload = memoryview(payload)[:len(payload) - len(payload) % self.RECORD.size]
+        for fields in self.RECORD.iter_unpack(payload):
+            yield self.unpack(fields)
+
+    def segment_tail(self, index):
+        # (records in a segment, its newest record or None), a .bin segment only has
+        # its last record read
+        if os.path.exists(self.legacy_path(index)):
+            count, last = 0, None
+            for record in self.read_segment(index):
+                count, last = count + 1, record
+            return count, last
+        path = self.segment_path(index)
+        count = os.path.getsize(path) // self.RECORD.size
+        if not count:
+            return 0, None
+        with open(path, 'rb') as f:
+            f.seek((count - 1) * self.RECORD.size)
+            return count, self.unpack(self.RECORD.unpack(f.read(self.RECORD.size)))
+
+    def prune_before(self, timestamp):
+        # Removes the closed segments whose newest record is older than timestamp,
+        # the segment being appended to is never touched. Returns the segments removed.
+        removed = 0
+        for index in self.list_segments():
+            if index >= self.segment_index:
+                break
+            _, last = self.segment_tail(index)
+            last_timestamp = None if last is None else last[0]
+            if isinstance(last_timestamp, str):
+                last_timestamp = timestamp_to_epoch(last_timestamp)
+            if last_timestamp is not None and last_timestamp >= timestamp:
+                break
+            for path in (self.segment_path(index), self.legacy_path(index)):
+                if os.path.exists(path):
+                    os.remove(path)
+            removed += 1
+        return removed
+
+    def read_all(self):
+        for index in self.list_segments():
+            yield from self.read_segment(index)
+
+    def oldest(self):
+        # The first record, None in an empty log
+        for index in self.list_segments():
+            for record in self.read_segment(index):
+                return record
+        return None
+
+    def close(self):
+        if self.segment_file is not None:
+            self.segment_file.close()
+            self.segment_file = None
+
+# Every register of one PZEM-004T input register read, in V, A, W, Wh, Hz, a 0-1
+# power factor and the over-power alarm
+Measurement = namedtuple('Measurement', ['voltage', 'current', 'power', 'energy', 'frequency', 'power_factor', 'alarm'])
+
+class MeasurementLog(SampleLog):
+    # Full Measurement history of one meter for power quality analysis, in the same
+    # segment files as the SampleLog. A record is the reading's epoch as a double
+    # followed by the registers as the meter sends them: decivolts, milliamps,
+    # deciwatts, Wh, decihertz, hundredths of power factor and the alarm flag,
+    # 26 bytes a reading. Records are (epoch seconds, Measurement).
+    RECORD = struct.Struct('<dHIIIHBB')
+    KIND = 'measurement_log'
+
+    def pack(self, record):
+        timestamp, measurement = record
+        return self.RECORD.pack(timestamp, round(measurement.voltage * 10), round(measurement.current * 1000), round(measurement.power * 10),
+                                measurement.energy, round(measurement.frequency * 10), round(measurement.power_factor * 100), measurement.alarm)
+
+    def unpack(self, fields):
+        timestamp, voltage, current, power, energy, frequency, power_factor, alarm = fields
+        return timestamp, Measurement(voltage / 10.0, current / 1000.0, power / 10.0, energy, frequency / 10.0, power_factor / 100.0, bool(alarm))
+
+class Codec:
+    # Serialization used by LocalDataManager for the local store, checkpoints and
+    # backups, named "<serializer>" or "<serializer>+<compression>":
+    #   serializer  'json' (indent=4, the original format), 'json-compact', 'orjson',
+    #               'msgpack', or 'fast-json' (orjson when installed, else json-compact)
+    #   compression 'gzip' or 'zstd'
+    # decode() detects the format from the payload itself, so files written with any
+    # codec, including the existing indented TestJson.json, load without conversion.
+    GZIP_MAGIC = b"\x1f\x8b"
+    ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+    def __init__(self, name='json-compact', level=None):
+        self.name = name
+        serializer, _, compression = name.partition('+')
+        if serializer == 'fast-json':
+            serializer = 'orjson' if orjson is not None else 'json-compact'
+        if serializer not in ('json', 'json-compact', 'orjson', 'msgpack'):
+            raise ValueError(f"Unknown serializer: {serializer}")
+        if compression not in ('', 'gzip', 'zstd'):
+            raise ValueError(f"Unknown compression: {compression}")
+        if serializer == 'orjson' and orjson is None:
+            raise ValueError("orjson is not installed")
+        if serializer == 'msgpack' and msgpack is None:
+            raise ValueError("msgpack is not installed")
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("zstandard is not installed")
+        self.serializer = serializer
+        self.compression = compression
+        self.level = level
+
+    def encode(self, data):
+        if self.serializer == 'json':
+            payload = json.dumps(data, indent=4).encode()
+        elif self.serializer == 'json-compact':
+            payload = json.dumps(data, separators=(',', ':')).encode()
+        elif self.serializer == 'orjson':
+            payload = orjson.dumps(data)
+        else:
+            payload = msgpack.packb(data)
+        if self.compression == 'gzip':
+            return gzip.compress(payload, compresslevel=self.level or 6)
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor(level=self.level or 3).compress(payload)
+        return payload
+
+    def decode(self, payload):
+        if payload.startswith(self.GZIP_MAGIC):
+            payload = gzip.decompress(payload)
+        elif payload.startswith(self.ZSTD_MAGIC):
+            if zstandard is None:
+                raise ValueError("zstandard is not installed")
+            payload = zstandard.ZstdDecompressor().decompress(payload)
+        if payload.lstrip()[:1] in (b'{', b'['):
+            return orjson.loads(payload) if orjson is not None else json.loads(payload)
+        if msgpack is None:
+            raise ValueError("msgpack is not installed")
+        return msgpack.unpackb(payload)
+
+class CheckpointStore:
+    # Generations of a small checkpoint, each saved with atomic_write as
+    # <path>.<generation>. Every file starts with a header line holding the
+    # generation, payload length and CRC32. load() walks generations newest first
+    # by file name and returns the first one whose checksum matches, so older
+    # candidates are never opened. Only the newest `keep` generations are kept.
+    HEADER = b"#ipecs-checkpoint"
+
+    def __init__(self, path, keep=3):
+        self.path = path
+        self.keep = keep
+        self.directory = os.path.dirname(path) or '.'
+        self.prefix = os.path.basename(path) + '.'
+        generations = self.list_generations()
+        self.generation = generations[-1] if generations else 0
+
+    def generation_path(self, generation):
+        return f"{self.path}.{generation:010d}"
+
+    def list_generations(self):
+        generations = []
+        for name in os.listdir(self.directory):
+            suffix = name[len(self.prefix):]
+            if name.startswith(self.prefix) and suffix.isdigit():
+                generations.append(int(suffix))
+        return sorted(generations)
+
+    def save(self, payload):
+        generation = self.generation + 1
+        header = self.HEADER + f" {generation} {len(payload)} {zlib.crc32(payload):08x}\n".encode()
+        atomic_write(self.generation_path(generation), header + payload, kind='checkpoint')
+        self.generation = generation
+        for old_generation in self.list_generations()[:-self.keep]:
+            try:
+                os.remove(self.generation_path(old_generation))
+            except OSError as e:
+                print("Remove Checkpoint Error: ", e)
+
+    def read_generation(self, generation):
+        try:
+            with open(self.generation_path(generation), 'rb') as f:
+                header = f.readline().split()
+                payload = f.read()
+            if len(header) != 4 or header[0] != self.HEADER:
+                return None
+            if int(header[2]) != len(payload) or int(header[3], 16) != zlib.crc32(payload):
+                return None
+            return payload
+        except (OSError, ValueError):
+            return None
+
+    def load(self):
+        for generation in reversed(self.list_generations()):
+            payload = self.read_generation(generation)
+            if payload is not None:
+                return payload
+            print("Skipping Corrupt Checkpoint Generation: ", generation)
+        return None
+
+class SqliteStore:
+    # One room's history in SQLite: samples keyed by epoch milliseconds (the rowid,
+    # so range queries are index scans) and a key/value table for the scalar room
+    # fields. WAL mode and commits batched every commit_interval seconds keep SD
+    # card writes low, close() commits whatever is left. A write is never held back
+    # longer than that, commit_due() commits it when no further write comes.
+    def __init__(self, db_file, commit_interval=30):
+        self.db_file = db_file
+        self.commit_interval = commit_interval
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_file, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS samples (ts_ms INTEGER PRIMARY KEY, value REAL NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS room_fields (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.connection.commit()
+        self.last_commit = time.monotonic()
+        self.uncommitted = False
+
+    def is_empty(self):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM room_fields LIMIT 1").fetchone() is None
+
+    def append_samples(self, samples):
+        # Samples in the same millisecond replace each other, like keys in the JSON dict
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO samples (ts_ms, value) VALUES (?, ?)",
+                                        [(round(timestamp * 1000), value) for timestamp, value in samples])
+            self.uncommitted = True
+            self.maybe_commit()
+
+    def write_fields(self, fields):
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO room_fields (key, value) VALUES (?, ?)",
+                                        [(key, json.dumps(value)) for key, value in fields.items()])
+            self.uncommitted = True
+            self.maybe_commit()
+
+    def read_fields(self):
+        with self.lock:
+            return {key: json.loads(value) for key, value in self.connection.execute("SELECT key, value FROM room_fields")}
+
+    def read_samples(self, start_ms=None, end_ms=None):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT ts_ms, value FROM samples WHERE ts_ms >= ? AND ts_ms < ? ORDER BY ts_ms",
+                (start_ms if start_ms is not None else -2 ** 63, end_ms if end_ms is not None else 2 ** 63 - 1)).fetchall()
+
+    def count_samples_before(self, ts_ms):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM samples WHERE ts_ms < ?", (ts_ms,)).fetchone()[0]
+
+    def oldest_sample_ms(self):
+        with self.lock:
+            return self.connection.execute("SELECT MIN(ts_ms) FROM samples").fetchone()[0]
+
+    def delete_samples_before(self, ts_ms):
+        with self.lock:
+            deleted = self.connection.execute("DELETE FROM samples WHERE ts_ms < ?", (ts_ms,)).rowcount
+            self.uncommitted = True
+            self.maybe_commit()
+            return deleted
+
+    def energy_between(self, start_ms, end_ms=None):
+        with self.lock:
+            total = self.connection.execute(
+                "SELECT SUM(value) FROM samples WHERE ts_ms >= ? AND ts_ms < ?",
+                (start_ms, end_ms if end_ms is not None else 2 ** 63 - 1)).fetchone()[0]
+            return total or 0
+
+    def energy_since_timestamp(self, timestamp):
+        # e.g. the energy since the last synced PowerConsumption key
+        return self.energy_between(round(timestamp_to_epoch(timestamp) * 1000) + 1)
+
+    def todays_usage(self):
+        midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        return self.energy_between(int(midnight.timestamp() * 1000))
+
+    def maybe_commit(self):
+        if self.uncommitted and time.monotonic() - self.last_commit >= self.commit_interval:
+            self.connection.commit()
+            self.last_commit = time.monotonic()
+            self.uncommitted = False
+
+    def commit_due(self):
+        with self.lock:
+            self.maybe_commit()
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+            self.last_commit = time.monotonic()
+            self.uncommitted = False
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+    def migrate_from_json(self, json_file, backup_file, room_id, codec):
+        # Seeds an empty database from the TestJson.json/TestJson_backup.json pair,
+        # falling back to the backup when the primary file is missing or truncated
+        local_data = None
+        for source in (json_file, backup_file):
+            try:
+                with open(source, 'rb') as f:
+                    local_data = codec.decode(f.read())
+                break
+            except (OSError, ValueError) as e:
+                print("Migrate Source Error: ", source, e)
+        room_data = dict((local_data or {}).get("Rooms", {}).get(room_id, {}))
+        power_data = room_data.pop("PowerConsumption", {})
+        self.append_samples([(timestamp_to_epoch(key), value) for key, value in power_data.items()])
+        self.write_fields(room_data)
+        self.commit()
+        print("Migrated Local Data to SQLite: ", len(power_data), " samples")
 
 class LocalDataManager:
-    def __init__(self, json_file, backup_file):
+    # storage_mode 'json' rewrites the whole json_file on every update,
+    # storage_mode 'log' appends samples to a SampleLog and only checkpoints the
+    # scalar room fields (CurrentCredit, ElectricityPrice, ...) to a small file.
+    # storage_mode 'sqlite' keeps samples and fields in a SqliteStore.
+    # codec is the Codec name used for json_file, checkpoints and backups.
+    # In 'log' and 'sqlite' mode every room_id gets its own files, so rooms never
+    # rewrite each other's data. 'json' mode is single-room only.
+    def __init__(self, json_file, backup_file, storage_mode='json', log_dir=None, room_id="Room-1", codec='json-compact'):
         self.json_file = json_file
         self.backup_file = backup_file
+        self.storage_mode = storage_mode
+        self.room_id = room_id
+        self.codec = Codec(codec)
+        if self.storage_mode == 'log':
+            base = os.path.splitext(self.json_file)[0] + '_' + room_id
+            self.checkpoint_store = CheckpointStore(base + '_checkpoint.json')
+            self.sample_log = SampleLog(log_dir or base + '_segments')
+            if not self.checkpoint_store.list_generations():
+                self.migrate_to_log()
+        elif self.storage_mode == 'sqlite':
+            self.sqlite_store = SqliteStore(os.path.splitext(self.json_file)[0] + '_' + room_id + '.sqlite3')
+            if self.sqlite_store.is_empty():
+                self.sqlite_store.migrate_from_json(self.json_file, self.backup_file, room_id, self.codec)
 
     def read_local_data(self):
         try:
-            with open(self.json_file, 'r') as f:
-                return json.load(f)
+            if self.storage_mode in ('log', 'sqlite'):
+                room_data, power_series = self.read_room()
+                room_data["PowerConsumption"] = power_series.to_firebase_dict()
+                return {"Rooms": {self.room_id: room_data}}
+            try:
+                return self.load_file(self.json_file)
+            except (OSError, ValueError) as e:
+                print("Read Local Error, Using Backup: ", e)
+                return self.load_file(self.backup_file)
         except Exception as e:
             print("Read Local Error: ", e)
 
     def update_local_data(self, data):
         try:
             print("Updating Local")
-            self.create_backup()
-            with open(self.json_file, 'w') as f:
-                json.dump(data, f, indent=4)
+            if self.storage_mode == 'log':
+                self.write_checkpoint(data)
+                return
+            if self.storage_mode == 'sqlite':
+                room_data = data.get("Rooms", {}).get(self.room_id, {})
+                self.sqlite_store.write_fields({key: value for key, value in room_data.items() if key != "PowerConsumption"})
+                return
+            payload = self.codec.encode(data)
+            # The previous primary becomes the backup through a hard link, no bytes copied
+            try:
+                if os.path.exists(self.json_file):
+                    if os.path.exists(self.backup_file + '.tmp'):
+                        os.remove(self.backup_file + '.tmp')
+                    os.link(self.json_file, self.backup_file + '.tmp')
+                    os.replace(self.backup_file + '.tmp', self.backup_file)
+            except OSError:
+                self.create_backup()
+            atomic_write(self.json_file, payload)
         except Exception as e:
             print("Update Local Error: ", e)
+
+    def load_file(self, path):
+        with open(path, 'rb') as f:
+            return self.codec.decode(f.read())
+
+    def read_room(self, since=None):
+        # The room's scalar fields and its history as a PowerSeries, straight from
+        # the log or database without building the PowerConsumption dict. With since
+        # the log and database only load the samples from the epoch since on, the
+        # series' offset counts the older ones. 'json' mode always loads everything,
+        # its flushes rewrite the whole history.
+        if self.storage_mode == 'log':
+            payload = self.checkpoint_store.load()
+            if payload is None:
+                raise ValueError("No valid checkpoint generation")
+            room_data = self.codec.decode(payload).get("Rooms", {}).get(self.room_id, {})
+            segments = self.sample_log.list_segments()
+            skipped = 0
+            # Whole segments older than since are counted without being read
+            while since is not None and segments:
+                count, last = self.sample_log.segment_tail(segments[0])
+                if last is not None and (timestamp_to_epoch(last[0]) if isinstance(last[0], str) else last[0]) >= since:
+                    break
+                skipped += count
+                segments.pop(0)
+            power_series = PowerSeries()
+            for index in segments:
+                for timestamp, value in self.sample_log.read_segment(index):
+                    if isinstance(timestamp, str):
+                        timestamp = timestamp_to_epoch(timestamp)
+                    if since is not None and timestamp < since and not power_series.timestamps:
+                        skipped += 1
+                        continue
+                    power_series.append(timestamp, value)
+            power_series.offset = skipped
+            return room_data, power_series
+        if self.storage_mode == 'sqlite':
+            start_ms = None if since is None else round(since * 1000)
+            rows = self.sqlite_store.read_samples(start_ms)
+            skipped = 0 if start_ms is None else self.sqlite_store.count_samples_before(start_ms)
+            return self.sqlite_store.read_fields(), PowerSeries([ts_ms / 1000 for ts_ms, _ in rows], [value for _, value in rows], skipped)
+        local_data = self.read_local_data() or {}
+        room_data = dict(local_data.get("Rooms", {}).get(self.room_id, {}))
+        return room_data, PowerSeries.from_dict(room_data.pop("PowerConsumption", {}))
+
+    def oldest_sample(self):
+        # Epoch of the oldest stored sample, None without samples or in 'json' mode
+        try:
+            if self.storage_mode == 'log':
+                oldest = self.sample_log.oldest()
+                if oldest is not None:
+                    return timestamp_to_epoch(oldest[0]) if isinstance(oldest[0], str) else oldest[0]
+            elif self.storage_mode == 'sqlite':
+                oldest_ms = self.sqlite_store.oldest_sample_ms()
+                if oldest_ms is not None:
+                    return oldest_ms / 1000
+        except Exception as e:
+            print("Read Oldest Sample Error: ", e)
+        return None
+
+    def write_checkpoint(self, data):
+        # Only this room's scalar fields are written, PowerConsumption lives in the sample log
+        room_data = data.get("Rooms", {}).get(self.room_id, {})
+        checkpoint = {"Rooms": {self.room_id: {key: value for key, value in room_data.items() if key != "PowerConsumption"}}}
+        self.checkpoint_store.save(self.codec.encode(checkpoint))
+
+    def append_power_consumption(self, samples):
+        try:
+            if self.storage_mode == 'log':
+                self.sample_log.append(samples)
+            elif self.storage_mode == 'sqlite':
+                self.sqlite_store.append_samples(samples)
+        except Exception as e:
+            print("Append Power Consumption Error: ", e)
+
+    def persist_changes(self, local_data, dirty_keys, samples):
+        try:
+            if self.storage_mode == 'log':
+                if samples:
+                    self.sample_log.append(samples)
+                if dirty_keys:
+                    self.write_checkpoint(local_data)
+            elif self.storage_mode == 'sqlite':
+                # Only the changed fields are written, not the whole room
+                if samples:
+                    self.sqlite_store.append_samples(samples)
+                room_data = local_data["Rooms"][self.room_id]
+                self.sqlite_store.write_fields({key: room_data[key] for key in dirty_keys if key in room_data})
+            else:
+                self.update_local_data(local_data)
+            return True
+        except Exception as e:
+            print("Persist Changes Error: ", e)
+            return False
+
+    def commit_due(self):
+        # Called on every flush, SQLite's batched commit must not wait for the next write
+        try:
+            if self.storage_mode == 'sqlite':
+                self.sqlite_store.commit_due()
+        except Exception as e:
+            print("Commit Error: ", e)
+
+    def prune_samples(self, before):
+        # Drops stored samples older than the epoch before. 'json' mode needs nothing,
+        # the next flush rewrites the file from the pruned PowerSeries.
+        try:
+            if self.storage_mode == 'log':
+                return self.sample_log.prune_before(before)
+            if self.storage_mode == 'sqlite':
+                return self.sqlite_store.delete_samples_before(round(before * 1000))
+        except Exception as e:
+            print("Prune Samples Error: ", e)
+        return 0
+
+    def migrate_to_log(self):
+        # One-time seed of the log storage from the existing TestJson.json history
+        try:
+            local_data = {"Rooms": {self.room_id: {}}}
+            if os.path.exists(self.json_file):
+                local_data = self.load_file(self.json_file)
+            power_data = local_data.get("Rooms", {}).get(self.room_id, {}).get("PowerConsumption", {})
+            if power_data and not self.sample_log.list_segments():
+                self.sample_log.append(PowerSeries.from_dict(power_data).samples())
+            self.write_checkpoint(local_data)
+            print("Migrated Local Data to Sample Log.")
+        except Exception as e:
+            print("Migrate Local Data Error: ", e)
             
     def update_room_data(self, local_data, key, value):
         try:
-            room_data = local_data.get("Rooms", {}).get("Room-1", {})
+            room_data = local_data.get("Rooms", {}).get(self.room_id, {})
             room_data[key] = value
-            local_data["Rooms"]["Room-1"] = room_data
+            local_data["Rooms"][self.room_id] = room_data
         except Exception as e:
             print("Update Room Data Error: ", e)
 
     def get_room_data(self, local_data, key):
         try:
-            return local_data.get("Rooms", {}).get("Room-1", {}).get(key)
+            return local_data.get("Rooms", {}).get(self.room_id, {}).get(key)
         except Exception as e:
             print("Get Room Data Error: ", e)
             return 0
     def update_power_consumption(self, local_data, current_datetime, power_consumption):
         try:
-            room_data = local_data.get("Rooms", {}).get("Room-1", {})
+            room_data = local_data.get("Rooms", {}).get(self.room_id, {})
             power_data = room_data.get("PowerConsumption", {})
             power_data[current_datetime] = power_consumption
             room_data["PowerConsumption"] = power_data
-            local_data["Rooms"]["Room-1"] = room_data
+            local_data["Rooms"][self.room_id] = room_data
+            self.append_power_consumption([(timestamp_to_epoch(current_datetime), power_consumption)])
         except Exception as e:
             print("Update Power Consumption Error: ", e)
             
     def create_backup(self):
+        # Byte copies, the backup keeps whatever codec the primary was written with
         try:
-            with open(self.json_file, 'r') as f:
-                backup_data = json.load(f)
-            with open(self.backup_file, 'w') as backup_file:
-                json.dump(backup_data, backup_file, indent=4)
+            with open(self.json_file, 'rb') as f:
+                backup_data = f.read()
+            atomic_write(self.backup_file, backup_data, kind='backup')
         except Exception as e:
             print("Backup Error: ", e)
                 
     def restore_from_backup(self):
         try:
-            with open(self.backup_file, 'r') as backup_file:
-                backup_data = json.load(backup_file)
-            with open(self.json_file, 'w') as f:
-                json.dump(backup_data, f, indent=4)
+            backup_data = self.load_file(self.backup_file)
+            atomic_write(self.json_file, self.codec.encode(backup_data))
             print("Restoring Data from Backup.")
         except Exception as e:
             print("Restoring Failed: ", e)
 
-class Pzem004T:
-    def __init__(self, port):
+# Immutable view of a RoomState. fields is read-only, and since the PowerSeries is
+# append-only its first sample_count samples never change after publishing.
+RoomSnapshot = namedtuple('RoomSnapshot', ['fields', 'sample_count', 'version'])
+
+# Credit ledger. Firebase's CurrentCredit is the balance, the app's top-ups raise
+# it and the device only ever takes deductions off it with deduct_credit, so
+# neither side overwrites the other. Locally the room keeps
+#   LedgerBalance  the last balance seen on Firebase
+#   LedgerPending  deductions billed but not yet applied to Firebase
+#   LedgerSequence number of deduction batches applied so far
+#   LedgerOutbox   ledger entries of applied batches not yet written to
+#                  CreditLedger, {"<sequence>": {"Deduction", "Balance", "Timestamp"}}
+# and CurrentCredit is LedgerBalance - LedgerPending, which stays right through
+# any offline period. Each function returns the changed fields.
+
+def ledger_fields(fields):
+    # Rooms from before the ledger start from their CurrentCredit with nothing pending
+    return fields.get("LedgerBalance", fields.get("CurrentCredit", 0)), fields.get("LedgerPending", 0)
+
+def ledger_deduct(fields, deduction):
+    balance, pending = ledger_fields(fields)
+    pending = round(pending + deduction, 7)
+    return {"LedgerBalance": balance, "LedgerPending": pending, "CurrentCredit": max(balance - pending, 0)}
+
+def ledger_observe_balance(fields, balance):
+    _, pending = ledger_fields(fields)
+    return {"LedgerBalance": balance, "LedgerPending": pending, "CurrentCredit": max(balance - pending, 0)}
+
+def ledger_acknowledge(fields, deduction, balance, now):
+    _, pending = ledger_fields(fields)
+    pending = max(round(pending - deduction, 7), 0)
+    sequence = fields.get("LedgerSequence", 0)
+    outbox = dict(fields.get("LedgerOutbox") or {})
+    outbox[f"{sequence:010d}"] = {"Deduction": deduction, "Balance": balance, "Timestamp": epoch_to_timestamp(now)}
+    return {
+        "LedgerBalance": balance,
+        "LedgerPending": pending,
+        "LedgerSequence": sequence + 1,
+        "LedgerOutbox": outbox,
+        "CurrentCredit": max(balance - pending, 0),
+    }
+
+def ledger_mark_uploaded(fields, keys):
+    outbox = fields.get("LedgerOutbox") or {}
+    return {"LedgerOutbox": {key: entry for key, entry in outbox.items() if key not in keys}}
+
+# RoomState.modify functions that another process can ask for by name, see RoomMirror
+
+def firebase_field_changes(fields, firebase_data):
+    # Firebase's CurrentCredit is the ledger balance, a top-up from the app just raises it
+    return {
+        "CreditCriticalLevel": firebase_data['CreditCriticalLevel'],
+        "ElectricityPrice": firebase_data['ElectricityPrice'],
+        **ledger_observe_balance(fields, firebase_data['CurrentCredit']),
+    }, None
+
+def ledger_acknowledgement(fields, deduction, balance, now):
+    return ledger_acknowledge(fields, deduction, balance, now), None
+
+def ledger_upload(fields, keys):
+    return ledger_mark_uploaded(fields, keys), None
+
+MODIFY_COMMANDS = {function.__name__: function for function in (firebase_field_changes, ledger_acknowledgement, ledger_upload)}
+
+class RoomState:
+    # Owner of one room (the local_manager's room_id), loaded from disk once at startup.
+    # Every mutation (samples, credit deductions, top-ups, price changes) is a command
+    # on a SimpleQueue applied in order by the owner thread, so a deduction and a
+    # top-up can never overwrite each other. Readers never lock, they read the
+    # RoomSnapshot published after each command.
+    # flush() persists only the keys and samples that changed since the last flush,
+    # the disk I/O runs on the flusher thread, never on the owner thread.
+    # PowerConsumption is held as a PowerSeries, samples are (epoch seconds, kWh).
+    # history_since only loads the samples from that epoch on, see read_room, so a
+    # long history does not hold up metering at startup.
+    def __init__(self, local_manager, flush_interval=5, clock=SYSTEM_CLOCK, history_since=None):
+        self.local_manager = local_manager
+        self.room_id = local_manager.room_id
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.commands = queue.SimpleQueue()
+        self.dirty_keys = set()
+        self.pending_samples = []
+        try:
+            self.room_data, self.power_series = local_manager.read_room(history_since)
+        except Exception as e:
+            print("Read Room Error: ", e)
+            self.room_data, self.power_series = {}, PowerSeries()
+        # The oldest sample left on disk, for the first Firebase retention run
+        self.oldest_stored = local_manager.oldest_sample() if self.power_series.offset else None
+        self.snapshot = RoomSnapshot(MappingProxyType(dict(self.room_data)), len(self.power_series), 0)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            function, args, future, queued_at = self.commands.get()
+            try:
+                result = function(*args)
+            except Exception as e:
+                print("Room State Command Error: ", e)
+                future.set_exception(e)
+                continue
+            self.snapshot = RoomSnapshot(MappingProxyType(dict(self.room_data)), len(self.power_series), self.snapshot.version + 1)
+            STATE_COMMAND_SECONDS.observe(time.perf_counter() - queued_at, room=self.room_id)
+            # The result is only handed out once the snapshot shows the change
+            future.set_result(result)
+
+    def submit(self, function, *args):
+        # Queues function(*args) for the owner thread, returns a Future of its result
+        future = Future()
+        self.commands.put((function, args, future, time.perf_counter()))
+        return future
+
+    def call(self, function, *args):
+        return self.submit(function, *args).result()
+
+    def get(self, key, default=None):
+        return self.snapshot.fields.get(key, default)
+
+    def set(self, key, value):
+        return self.submit(self.apply_fields, {key: value})
+
+    def set_fields(self, fields):
+        return self.submit(self.apply_fields, fields)
+
+    def add_power_consumption(self, timestamp, power_consumption):
+        return self.submit(self.apply_consumption, [(timestamp, power_consumption)], 0)
+
+    def record_consumption(self, samples, power_consumption):
+        # Appends samples and deducts power_consumption kWh at the current
+        # ElectricityPrice in one command, returns the new CurrentCredit
+        return self.call(self.apply_consumption, samples, power_consumption)
+
+    def modify(self, function, *args):
+        # function(fields, *args) runs on the owner thread with the read-only current
+        # fields and returns (changed fields, result). Nothing can change the room in between.
+        return self.call(self.apply_modify, function, *args)
+
+    def apply_fields(self, fields):
+        for key, value in fields.items():
+            if key not in self.room_data or self.room_data[key] != value:
+                self.room_data[key] = value
+                self.dirty_keys.add(key)
+
+    def apply_consumption(self, samples, power_consumption):
+        for timestamp, value in samples:
+            self.power_series.append(timestamp, value)
+            self.pending_samples.append((timestamp, value))
+        if power_consumption > 0:
+            deduction = power_consumption * self.room_data.get("ElectricityPrice", 0)
+            self.apply_fields(ledger_deduct(self.room_data, deduction))
+        return self.room_data.get("CurrentCredit", 0)
+
+    def apply_modify(self, function, *args):
+        changes, result = function(MappingProxyType(self.room_data), *args)
+        self.apply_fields(changes)
+        return result
+
+    def apply_retention(self, before):
+        # Swaps in a pruned series, readers holding the old one are unaffected
+        power_series = self.power_series.dropped_before(before)
+        dropped = len(self.power_series.timestamps) - len(power_series.timestamps)
+        if dropped:
+            self.power_series = power_series
+            if self.local_manager.storage_mode == 'json':
+                self.dirty_keys.add("PowerConsumption")
+        return dropped
+
+    def prune(self, before):
+        # Drops the in-memory samples older than the epoch before, returns how many
+        return self.call(self.apply_retention, before)
+
+    def take_changes(self):
+        dirty_keys = self.dirty_keys
+        samples = self.pending_samples
+        self.dirty_keys = set()
+        self.pending_samples = []
+        return dict(self.room_data), len(self.power_series), dirty_keys, samples
+
+    def restore_changes(self, dirty_keys, samples):
+        self.dirty_keys |= dirty_keys
+        self.pending_samples = samples + self.pending_samples
+
+    def samples_since(self, position, limit=None):
+        sample_count = self.snapshot.sample_count
+        end = sample_count if limit is None else min(sample_count, position + limit)
+        return self.power_series.samples(position, end), end
+
+    def total_between(self, start, end):
+        return self.power_series.total_between(start, end)
+
+    def find_sample_position(self, timestamp, position_hint):
+        return self.power_series.find_position(timestamp, position_hint)
+
+    def first_position_at(self, timestamp):
+        return self.power_series.first_position_at(timestamp)
+
+    def oldest_sample(self):
+        # Epoch of the oldest sample still held, on disk or in memory, None without samples
+        timestamps = self.power_series.timestamps
+        oldest = timestamps[0] if timestamps else None
+        if self.oldest_stored is not None:
+            return self.oldest_stored if oldest is None else min(self.oldest_stored, oldest)
+        return oldest
+
+    def flush(self):
+        room_data, sample_count, dirty_keys, samples = self.call(self.take_changes)
+        if not dirty_keys and not samples:
+            self.local_manager.commit_due()
+            return
+        if self.local_manager.storage_mode == 'json':
+            # Built here from the append-only history, not on the owner thread
+            room_data["PowerConsumption"] = self.power_series.to_firebase_dict(0, sample_count)
+        local_data = {"Rooms": {self.room_id: room_data}}
+        if not self.local_manager.persist_changes(local_data, dirty_keys, samples):
+            self.submit(self.restore_changes, dirty_keys, samples)
+
+    def run_flusher(self):
+        while True:
+            self.clock.sleep(self.flush_interval)
+            self.flush()
+
+# Rollup nodes of the partitioned layout: name, key format of a window's start,
+# the start of the window holding a moment, and the window length
+ROLLUPS = [
+    ("Minute", '%Y-%m-%d/%H:%M', lambda moment: moment.replace(second=0, microsecond=0), timedelta(minutes=1)),
+    ("Hour", '%Y-%m-%d/%H', lambda moment: moment.replace(minute=0, second=0, microsecond=0), timedelta(hours=1)),
+    ("Day", '%Y-%m/%d', lambda moment: moment.replace(hour=0, minute=0, second=0, microsecond=0), timedelta(days=1)),
+]
+
+class PowerConsumptionSync:
+    # Uploads only the samples newer than the last one Firebase acknowledged, as
+    # one multi-path update. The cursor is saved to watermark_file so a restart
+    # resumes instead of re-uploading history. The cursor is saved at most every
+    # watermark_interval seconds, a restart from an older one only sends the same
+    # seconds and rollup totals again, which overwrite themselves.
+    # layout 'partitioned' writes samples to PowerConsumption/<room>/<yyyy-mm-dd>/<HH:MM:SS>
+    # and their totals to PowerRollups/<room>/Minute|Hour|Day, so a write only touches
+    # today's nodes and a month of usage is the one node PowerRollups/<room>/Day/<yyyy-mm>.
+    # Credit ledger entries go to CreditLedger/<room>/<yyyy-mm-dd>/<sequence>. History
+    # left in the legacy node is moved over a day at a time, see legacy_day_payload.
+    # layout 'legacy' keeps the single Rooms/<room>/PowerConsumption node keyed
+    # "%m-%d-%Y %H:%M:%S" and Rooms/<room>/CreditLedger/<sequence>.
+    def __init__(self, firebase_manager, room_state, watermark_file, max_batch=500, layout='partitioned', clock=SYSTEM_CLOCK, watermark_interval=60):
+        self.firebase_manager = firebase_manager
+        self.room_state = room_state
+        self.watermark_file = watermark_file
+        self.max_batch = max_batch
+        self.layout = layout
+        self.clock = clock
+        self.watermark_interval = watermark_interval
+        self.next_watermark_save = 0
+        # Epoch of the last uploaded sample while the saved watermark is behind it
+        self.unsaved_timestamp = None
+        self.position = self.load_watermark()
+
+    @staticmethod
+    def read_watermark(watermark_file):
+        # (position, epoch of the last uploaded sample), None without a watermark
+        try:
+            with open(watermark_file, 'r') as f:
+                watermark = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if "LastTimestamp" in watermark:
+            return watermark["Position"], watermark["LastTimestamp"]
+        return watermark["Position"], timestamp_to_epoch(watermark["LastKey"])
+
+    @classmethod
+    def history_start(cls, watermark_file):
+        # Midnight of the day the watermark points into, the oldest sample a sync
+        # can still need as the rollups cover whole days. None without a watermark.
+        watermark = cls.read_watermark(watermark_file)
+        if watermark is None:
+            return None
+        return datetime.fromtimestamp(watermark[1]).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+
+    def load_watermark(self):
+        watermark = self.read_watermark(self.watermark_file)
+        if watermark is None:
+            return 0
+        position_hint, last_timestamp = watermark
+        position = self.room_state.find_sample_position(last_timestamp, position_hint)
+        if position is None:
+            print("Sync Watermark Not Found, Uploading Full History")
+            return 0
+        return position
+
+    def save_watermark(self, last_timestamp):
+        try:
+            atomic_write(self.watermark_file, json.dumps({"Position": self.position, "LastTimestamp": last_timestamp}).encode(), kind='watermark')
+        except Exception as e:
+            print("Save Sync Watermark Error: ", e)
+
+    def maybe_save_watermark(self):
+        if self.unsaved_timestamp is None or self.clock.monotonic() < self.next_watermark_save:
+            return
+        self.next_watermark_save = self.clock.monotonic() + self.watermark_interval
+        self.save_watermark(self.unsaved_timestamp)
+        self.unsaved_timestamp = None
+
+    def build_payload(self, samples, fields=None, ledger_entries=None):
+        # fields are room fields, e.g. {"CurrentCredit": 10}, ledger_entries the
+        # room's LedgerOutbox of credit ledger entries by sequence key
+        seconds = sorted({int(timestamp) for timestamp, _ in samples})
+        if self.layout == 'legacy':
+            payload = dict(fields or {})
+            for key, entry in (ledger_entries or {}).items():
+                payload[f"CreditLedger/{key}"] = entry
+            for second in seconds:
+                # Firebase keys have one-second resolution, each touched second is sent as
+                # its full total so samples split across two syncs still add up
+                payload[f"PowerConsumption/{epoch_to_timestamp(second)}"] = round(self.room_state.total_between(second, second + 1), 7)
+            return payload
+        room_id = self.room_state.room_id
+        payload = {f"Rooms/{room_id}/{key}": value for key, value in (fields or {}).items()}
+        for key, entry in (ledger_entries or {}).items():
+            day = datetime.fromtimestamp(timestamp_to_epoch(entry["Timestamp"]))
+            payload[f"CreditLedger/{room_id}/{day:%Y-%m-%d}/{key}"] = entry
+        windows = set()
+        for second in seconds:
+            moment = datetime.fromtimestamp(second)
+            payload[f"PowerConsumption/{room_id}/{moment:%Y-%m-%d/%H:%M:%S}"] = round(self.room_state.total_between(second, second + 1), 7)
+            for rollup in ROLLUPS:
+                windows.add((rollup, rollup[2](moment)))
+        # Rollups are recomputed from the local samples as full window totals, like the seconds
+        for (name, key_format, _, length), start in windows:
+            total = self.room_state.total_between(start.timestamp(), (start + length).timestamp())
+            payload[f"PowerRollups/{room_id}/{name}/{start.strftime(key_format)}"] = round(total, 7)
+        return payload
+
+    def legacy_day_payload(self, day, legacy, current):
+        # Moves one local day of the legacy Rooms/<room>/PowerConsumption node, legacy
+        # its "%m-%d-%Y %H:%M:%S" keys and values, into the partitioned layout in one
+        # multi-path update. Every legacy second is copied to the day's partitioned node
+        # unless current, that node as it is, already holds the second uploaded from the
+        # local samples, and only then is its legacy key deleted. No retention applies,
+        # the copies are pruned like any other partitioned day. The day's rollups are
+        # recomputed from both. Windows still being uploaded are recomputed from the
+        # local samples afterwards, which hold the legacy samples too on a controller
+        # upgraded in place.
+        room_id = self.room_state.room_id
+        payload = {}
+        seconds = {}
+        for key, value in legacy.items():
+            moment = datetime.strptime(key, TIMESTAMP_FORMAT)
+            seconds[moment] = value
+            if f"{moment:%H:%M:%S}" not in current:
+                payload[f"PowerConsumption/{room_id}/{moment:%Y-%m-%d/%H:%M:%S}"] = value
+            payload[f"Rooms/{room_id}/PowerConsumption/{key}"] = None
+        seconds.update((datetime.strptime(f"{day:%Y-%m-%d} {key}", '%Y-%m-%d %H:%M:%S'), value) for key, value in current.items())
+        for name, key_format, window_start, _ in ROLLUPS:
+            totals = {}
+            for moment, value in seconds.items():
+                start = window_start(moment)
+                totals[start] = totals.get(start, 0) + value
+            for start, total in totals.items():
+                payload[f"PowerRollups/{room_id}/{name}/{start.strftime(key_format)}"] = round(total, 7)
+        return payload
+
+    def sync(self, fields=None, ledger_entries=None):
+        samples, position = self.room_state.samples_since(self.position, self.max_batch)
+        if not samples and not fields and not ledger_entries:
+            self.maybe_save_watermark()
+            return True
+        room_id = self.room_state.room_id if self.layout == 'legacy' else None
+        if not self.firebase_manager.update_firebase_data(self.build_payload(samples, fields, ledger_entries), room_id):
+            return False
+        if samples:
+            self.position = position
+            self.unsaved_timestamp = samples[-1][0]
+        self.maybe_save_watermark()
+        return True
+
+class RetentionPolicy:
+    # Days of data kept per resolution on Firebase, None keeps it forever. local_days
+    # prunes the controller's own samples and measurements, which are kept forever
+    # unless it is given. Local samples are kept at least a day so today's Day rollup
+    # can always be recomputed from them.
+    def __init__(self, raw_days=30, minute_days=90, hour_days=400, day_days=None, ledger_days=400, local_days=None):
+        self.raw_days = None if raw_days is None else max(raw_days, 1)
+        self.minute_days = minute_days
+        self.hour_days = hour_days
+        self.day_days = day_days
+        self.ledger_days = ledger_days
+        self.local_days = None if local_days is None else max(local_days, 1)
+
+    def raw_cutoff(self, now):
+        # Epoch before which local samples are dropped, None when they are kept forever
+        if self.local_days is None:
+            return None
+        midnight = datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+        return (midnight - timedelta(days=self.local_days)).timestamp()
+
+    def remote_deletions(self, room_id, now, pruned_through, oldest=None):
+        # Multi-path deletions of the whole-day nodes that expired since pruned_through,
+        # a {"Raw": "yyyy-mm-dd", ...} of the last day deleted per resolution. The
+        # first run starts from oldest, the epoch of the oldest sample this room ever
+        # uploaded, nothing older can exist in the partitioned layout.
+        # Returns (deletions, new pruned_through).
+        today = datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+        deletions = {}
+        pruned_through = dict(pruned_through or {})
+        for name, days, path in [
+            ("Raw", self.raw_days, "PowerConsumption/{room}/{day:%Y-%m-%d}"),
+            ("Minute", self.minute_days, "PowerRollups/{room}/Minute/{day:%Y-%m-%d}"),
+            ("Hour", self.hour_days, "PowerRollups/{room}/Hour/{day:%Y-%m-%d}"),
+            ("Day", self.day_days, "PowerRollups/{room}/Day/{day:%Y-%m/%d}"),
+            ("Ledger", self.ledger_days, "CreditLedger/{room}/{day:%Y-%m-%d}"),
+        ]:
+            if days is None:
+                continue
+            last_day = today - timedelta(days=days + 1)
+            if name in pruned_through:
+                day = datetime.strptime(pruned_through[name], '%Y-%m-%d') + timedelta(days=1)
+            elif oldest is not None:
+                day = datetime.fromtimestamp(oldest).replace(hour=0, minute=0, second=0, microsecond=0)
+            else:
+                day = last_day + timedelta(days=1)
+            while day <= last_day:
+                deletions[path.format(room=room_id, day=day)] = None
+                day += timedelta(days=1)
+            pruned_through[name] = f"{last_day:%Y-%m-%d}"
+        return deletions, pruned_through
+
+class ModbusTimeout(ModbusInvalidResponseError):
+    # Raised by RtuSession for a slave that sent no response at all
+    pass
+
+def record_response_length(args):
+    # modbus_tk after_recv hook, keeps the length of each raw response on its master
+    master, response = args
+    master.last_response_length = len(response)
+
+if install_hook is not None:
+    install_hook("modbus.Master.after_recv", record_response_length)
+
+def is_modbus_timeout(error, master):
+    # modbus_tk raises the same ModbusInvalidResponseError for a slave that never
+    # answered and for a frame that arrived corrupted, a response of 0 bytes is the
+    # timeout. The length comes from the after_recv hook, only without it does this
+    # fall back to the error text of modbus_tk 1.1, "Response length is invalid 0".
+    length = getattr(master, 'last_response_length', None)
+    if length is not None:
+        return length == 0
+    return str(error) == "Response length is invalid 0"
+
+class RtuSession:
+    # One long-lived Modbus RTU master per serial adapter, shared by every meter on
+    # that RS-485 bus. The port stays open and is only reopened after a serial fault
+    # or max_invalid_responses corrupt frames in a row from the whole bus. A slave
+    # that does not answer says nothing about the port, its timeouts are counted
+    # per slave in timeouts and never reopen it.
+    def __init__(self, port, timeout=2.0, interchar_multiplier=1.5, interframe_multiplier=3.5, max_invalid_responses=3):
+        self.port = port
         self.serial = serial.Serial(
-            port='/dev/ttyUSB0',
+            port=port,
             baudrate=9600,
             bytesize=8,
             parity='N',
@@ -123,115 +1726,1191 @@ class Pzem004T:
             xonxoff=0
         )
         
-        self.master = modbus_rtu.RtuMaster(self.serial)
-        self.master.set_timeout(2.0)
+        self.master = modbus_rtu.RtuMaster(self.serial, interchar_multiplier=interchar_multiplier, interframe_multiplier=interframe_multiplier)
+        self.master.set_timeout(timeout)
         self.master.set_verbose(True)
+        self.timeout = timeout
+        self.current_timeout = timeout
+        self.max_invalid_responses = max_invalid_responses
+        self.invalid_responses = 0
+        self.timeouts = {}
+        self.reopen_count = 0
+        self.lock = threading.Lock()
+
+    def reopen_serial(self):
+        try:
+            self.serial.close()
+            self.serial.open()
+            self.reopen_count += 1
+            SERIAL_REOPENS.inc(port=self.port)
+            print("Reopened Serial Port: ", self.port)
+        except (SerialException, OSError) as e:
+            print("Reopen Serial Error: ", e)
+
+    def execute(self, slave_id, function_code, address, quantity, timeout=None):
+        with self.lock:
+            timeout = timeout or self.timeout
+            if timeout != self.current_timeout:
+                # Per-meter timeouts keep a dead slave from holding the bus for 2 s
+                self.master.set_timeout(timeout)
+                self.current_timeout = timeout
+            self.master.last_response_length = None
+            try:
+                data = self.master.execute(slave_id, function_code, address, quantity)
+            except ModbusInvalidResponseError as e:
+                if is_modbus_timeout(e, self.master):
+                    self.timeouts[slave_id] = self.timeouts.get(slave_id, 0) + 1
+                    raise ModbusTimeout(str(e)) from e
+                self.invalid_responses += 1
+                if self.invalid_responses >= self.max_invalid_responses:
+                    self.invalid_responses = 0
+                    self.reopen_serial()
+                raise
+            except (SerialException, OSError):
+                self.reopen_serial()
+                raise
+            self.invalid_responses = 0
+            self.timeouts[slave_id] = 0
+            return data
 
-    def pzem_sensor_data_read(self):
-        try:
-            self.serial.close()  # Close the serial connection
-            self.serial.open()  # Reopen the serial connection
-            data = self.master.execute(1, cst.READ_INPUT_REGISTERS, 0, 10)
-            voltage = data[0] / 10.0  # [V]
-            current = (data[1] + (data[2] << 16)) / 1000.0  # [A]
-            power = (data[3] + (data[4] << 16)) / 10.0  # [W]
-            print(power)
-            return power
-        except modbus_tk.exceptions.ModbusInvalidResponseError as e:
+class Pzem004T:
+    # A PZEM-004T at slave_id on an RtuSession. Meters sharing one RS-485 bus pass
+    # the same session, otherwise the meter opens its own session on port.
+    def __init__(self, port, slave_id=1, session=None, **session_options):
+        self.session = session if session is not None else RtuSession(port, **session_options)
+        self.port = port
+        self.slave_id = slave_id
+        self.error_count = 0
+        self.last_energy = None
+
+    def pzem_sensor_data_read(self, timeout=None):
+        # Returns a Measurement of all ten registers, None when the meter did not answer
+        try:
+            request_start = time.monotonic()
+            data = self.session.execute(self.slave_id, READ_INPUT_REGISTERS, 0, 10, timeout)
+            MODBUS_SECONDS.observe(time.monotonic() - request_start, port=self.port, slave_id=self.slave_id)
+            measurement = Measurement(
+                data[0] / 10.0,  # [V]
+                (data[1] + (data[2] << 16)) / 1000.0,  # [A]
+                (data[3] + (data[4] << 16)) / 10.0,  # [W]
+                data[5] + (data[6] << 16),  # [Wh] cumulative meter register
+                data[7] / 10.0,  # [Hz]
+                data[8] / 100.0,  # power factor
+                data[9] == 0xFFFF,  # power above the alarm threshold
+            )
+            self.last_energy = measurement.energy
+            print(measurement.power)
+            return measurement
+        except ModbusInvalidResponseError as e:
             print("Pzem Reader Error: ", e)
+            MODBUS_ERRORS.inc(port=self.port, slave_id=self.slave_id, kind='timeout' if isinstance(e, ModbusTimeout) else 'invalid_response')
+            self.error_count += 1
+            return None
+        except (SerialException, OSError) as e:
+            print("Pzem Serial Error: ", e)
+            MODBUS_ERRORS.inc(port=self.port, slave_id=self.slave_id, kind='serial')
+            self.error_count += 1
             return None
 
-class ElectricityController:
-    def __init__(self):
-        self.firebase_manager = FirebaseManager('/home/capstone/Downloads/econtrollectricity-firebase-adminsdk-r45sa-d9f7151c8b.json', 'https://econtrollectricity-default-rtdb.asia-southeast1.firebasedatabase.app/')
-        self.local_manager = LocalDataManager('/home/capstone/Downloads/TestJson.json', '/home/capstone/Downloads/TestJson_backup.json')
-        self.pzem_sensor = Pzem004T('/dev/ttyUSB0')
-        self.connection = False
-        self.snapshot_current_credit = 0
-        
-        self.local_data_lock = threading.Lock()
+class BusScheduler:
+    # Polls every meter on one RtuSession from its own thread, one scheduler per USB
+    # adapter so several buses are polled in parallel. Each meter has a poll_interval
+    # budget, a priority and a timeout, and a meter that stops answering is backed
+    # off exponentially so it cannot stall the others on every cycle.
+    # policy 'round_robin' polls the meter that has waited longest, 'priority' polls
+    # the due meter with the lowest priority number first.
+    def __init__(self, session, callback, policy='round_robin', backoff_max=60, clock=SYSTEM_CLOCK):
+        self.session = session
+        self.clock = clock
+        self.callback = callback
+        self.policy = policy
+        self.backoff_max = backoff_max
+        self.meters = []
+        self.thread = None
 
-    def handle_updates(self):
+    def add_meter(self, meter, poll_interval=1, priority=0, timeout=0.5):
+        self.meters.append({
+            "meter": meter,
+            "poll_interval": poll_interval,
+            "priority": priority,
+            "timeout": timeout,
+            "next_poll": 0,
+            "failures": 0,
+        })
+
+    def next_meter(self, now):
+        due = [entry for entry in self.meters if entry["next_poll"] <= now]
+        if not due:
+            return None
+        if self.policy == 'priority':
+            return min(due, key=lambda entry: (entry["priority"], entry["next_poll"]))
+        return min(due, key=lambda entry: entry["next_poll"])
+
+    def poll_once(self):
+        now = self.clock.monotonic()
+        entry = self.next_meter(now)
+        if entry is None:
+            return min(entry["next_poll"] for entry in self.meters) - now
+        loop_start = time.perf_counter()
+        try:
+            measurement = entry["meter"].pzem_sensor_data_read(entry["timeout"])
+        except Exception as e:
+            # A modbus exception reply or anything else unexpected backs this meter
+            # off like a timeout instead of ending the port's thread
+            print("Bus Read Error: ", e)
+            MODBUS_ERRORS.inc(port=entry["meter"].port, slave_id=entry["meter"].slave_id, kind='error')
+            measurement = None
+        if measurement is None:
+            entry["failures"] += 1
+            entry["next_poll"] = now + min(entry["poll_interval"] * 2 ** entry["failures"], self.backoff_max)
+        else:
+            entry["failures"] = 0
+            entry["next_poll"] = max(entry["next_poll"] + entry["poll_interval"], now)
+            try:
+                # The callback may return its own delay until this meter's next poll
+                delay = self.callback(entry["meter"], measurement)
+                if delay is not None:
+                    entry["next_poll"] = now + delay
+            except Exception as e:
+                print("Bus Callback Error: ", e)
+        LOOP_SECONDS.observe(time.perf_counter() - loop_start, loop='meter')
+        return 0
+
+    def run(self):
         while True:
-            time.sleep(.25)
-            print("InternetCheck")
-            firebase_data = self.firebase_manager.get_firebase_data()
-            
+            if not self.meters:
+                self.clock.sleep(1)
+                continue
+            wait = self.poll_once()
+            if wait > 0:
+                self.clock.sleep(wait)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+class EnergyCounter:
+    # Turns readings of the PZEM's cumulative energy register (Wh) into kWh deltas.
+    # The register rolls over to 0 after 9999.99 kWh, a drop from near wrap_at to a
+    # small value is a wraparound and any other drop is a meter reset.
+    def __init__(self, last_reading=None, wrap_at=10000000, wrap_window=100000):
+        self.last_reading = last_reading
+        self.wrap_at = wrap_at
+        self.wrap_window = wrap_window
+
+    def delta_kwh(self, reading):
+        last_reading = self.last_reading
+        self.last_reading = reading
+        if last_reading is None:
+            return 0
+        if reading >= last_reading:
+            delta = reading - last_reading
+        elif last_reading >= self.wrap_at - self.wrap_window and reading < self.wrap_window:
+            delta = self.wrap_at - last_reading + reading
+        else:
+            print("Pzem Energy Register Reset Detected")
+            delta = reading
+        return delta / 1000
+
+class AdaptiveSampler:
+    # Picks the delay until a meter's next poll from how its power changes. A jump of
+    # more than change_ratio of the load (and more than change_watts) polls again after
+    # min_interval, flat readings stretch the interval by backoff up to max_interval.
+    def __init__(self, base_interval=1, min_interval=0.25, max_interval=5, change_ratio=0.2, change_watts=5, backoff=1.5):
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.change_ratio = change_ratio
+        self.change_watts = change_watts
+        self.backoff = backoff
+        self.interval = base_interval
+        self.last_power = None
+        self.flat = False
+
+    def next_interval(self, power):
+        last_power = self.last_power
+        self.last_power = power
+        if last_power is None:
+            self.flat = False
+            self.interval = self.base_interval
+            return self.interval
+        change = abs(power - last_power)
+        self.flat = change <= self.change_watts or change <= self.change_ratio * max(power, last_power)
+        if self.flat:
+            self.interval = min(max(self.interval, self.min_interval) * self.backoff, self.max_interval)
+        else:
+            self.interval = self.min_interval
+        return self.interval
+
+class RunLengthEncoder:
+    # Coalesces the samples of a flat run into one sample stamped at the run's last
+    # reading, holding the run's whole energy. Samples still partition time, the run
+    # started at the previous stored sample. A run is closed by a load change or
+    # after max_run_seconds so the pending energy reaches storage and Firebase.
+    def __init__(self, max_run_seconds=60):
+        self.max_run_seconds = max_run_seconds
+        self.run_start = None
+        self.run_end = None
+        self.run_energy = 0
+        self.run_samples = 0
+
+    def add(self, timestamp, energy, flat):
+        # Returns the samples that are ready to be stored
+        if self.run_start is not None and flat and timestamp - self.run_start < self.max_run_seconds:
+            self.run_end = timestamp
+            self.run_energy += energy
+            self.run_samples += 1
+            return []
+        samples = self.flush()
+        self.run_start = self.run_end = timestamp
+        self.run_energy = energy
+        self.run_samples = 1
+        return samples
+
+    def expire(self, timestamp):
+        # Closes a run that no reading has extended for max_run_seconds, e.g. after a cutoff
+        if self.run_start is not None and timestamp - self.run_start >= self.max_run_seconds:
+            return self.flush()
+        return []
+
+    def flush(self):
+        if self.run_start is None:
+            return []
+        sample = (self.run_end, round(self.run_energy, 7))
+        self.run_start = self.run_end = None
+        self.run_energy = 0
+        self.run_samples = 0
+        return [sample]
+
+class RelayController:
+    # Drives one room's relay on state changes only, so the GPIO is written once per
+    # cutoff or reconnect instead of on every reading.
+    # The relay cuts at credit <= 0 and after a cutoff reconnects only above
+    # reconnect_credit, so a balance hovering around zero cannot chatter the relay.
+    # From the last power draw (W) and ElectricityPrice the controller predicts the
+    # moment credit runs out and its own thread cuts the relay then, so the overshoot
+    # past zero credit is the thread's wake-up latency, not the metering interval.
+    # The prediction counts from as_of, the monotonic time the credit was billed up
+    # to, or from the last reconnect when that is later, as nothing is used while the
+    # relay is off. It is only redone when the credit, power, price or relay state
+    # changes, so repeated updates with the same balance cannot push the cutoff later.
+    # critical_callbacks(room_id, credit, critical_level) run once each time credit
+    # falls to CreditCriticalLevel, and re-arm after it rises above it again.
+    def __init__(self, relay, room_id, reconnect_credit=1.0, clock=SYSTEM_CLOCK):
+        self.relay = relay
+        self.room_id = room_id
+        self.reconnect_credit = reconnect_credit
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.is_on = relay.is_lit
+        self.cut_off = False
+        self.credit = None
+        self.power = 0
+        self.price = None
+        self.critical_level = None
+        self.critical_armed = True
+        self.critical_callbacks = []
+        self.cutoff_at = None
+        self.prediction = None
+        self.on_since = None
+        self.thread = None
+
+    def switch(self, on):
+        # Called with the condition held
+        if self.is_on == on:
+            return
+        if on:
+            self.relay.on()
+        else:
+            self.relay.off()
+        self.is_on = on
+        self.cut_off = not on
+        if on:
+            self.on_since = self.clock.monotonic()
+        RELAY_CHANGES.inc(room=self.room_id, state='on' if on else 'off')
+        RELAY_STATE.set(1 if on else 0, room=self.room_id)
+
+    def update(self, credit, power=None, price=None, critical_level=None, as_of=None):
+        # power is the latest reading, price and critical_level the room's fields,
+        # None keeps the last known value. as_of None means credit is current now.
+        events = []
+        with self.condition:
+            self.credit = credit
+            if power is not None:
+                self.power = power
+            if price is not None:
+                self.price = price
+            if critical_level is not None:
+                self.critical_level = critical_level
+            if credit <= 0:
+                self.switch(False)
+            elif credit > (self.reconnect_credit if self.cut_off else 0):
+                self.switch(True)
+            if self.critical_level is not None:
+                if self.critical_armed and credit <= self.critical_level:
+                    self.critical_armed = False
+                    events.append((self.room_id, credit, self.critical_level))
+                elif credit > self.critical_level:
+                    self.critical_armed = True
+            prediction = (credit, self.power, self.price, self.is_on, as_of)
+            if prediction != self.prediction:
+                self.prediction = prediction
+                if as_of is None:
+                    as_of = self.clock.monotonic()
+                elif self.on_since is not None:
+                    as_of = max(as_of, self.on_since)
+                self.schedule_cutoff(as_of)
+        # Callbacks run outside the condition so a slow handler cannot delay a cutoff
+        for event in events:
+            CREDIT_CRITICAL_EVENTS.inc(room=self.room_id)
+            for callback in self.critical_callbacks:
+                try:
+                    callback(*event)
+                except Exception as e:
+                    print("Credit Critical Callback Error: ", e)
+
+    def schedule_cutoff(self, as_of):
+        # Called with the condition held
+        cutoff_at = None
+        if self.is_on and self.power > 0 and self.price:
+            credit_per_second = self.power / 1000 / 3600 * self.price
+            cutoff_at = as_of + self.credit / credit_per_second
+        self.cutoff_at = cutoff_at
+        self.condition.notify()
+
+    def seconds_left(self):
+        with self.condition:
+            return None if self.cutoff_at is None else max(self.cutoff_at - self.clock.monotonic(), 0)
+
+    def run(self):
+        with self.condition:
+            while True:
+                if self.cutoff_at is None:
+                    self.clock.wait(self.condition)
+                    continue
+                remaining = self.cutoff_at - self.clock.monotonic()
+                if remaining > 0:
+                    self.clock.wait(self.condition, remaining)
+                    continue
+                CUTOFF_LATENESS_SECONDS.observe(-remaining, room=self.room_id)
+                print("Predicted Credit Exhausted, Relay Off: ", self.room_id)
+                self.cutoff_at = None
+                # The next update predicts again, even with the same balance
+                self.prediction = None
+                self.switch(False)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+# One meter reading on its way from the acquisition stage to billing. monotonic and
+# timestamp are the clock's times at acquisition, measurement the meter's Measurement,
+# flat the AdaptiveSampler's verdict on the reading.
+Reading = namedtuple('Reading', ['room', 'monotonic', 'timestamp', 'measurement', 'flat'])
+
+class SamplePipeline:
+    # Decouples Modbus acquisition from billing and persistence. Bus threads put
+    # readings into a bounded ring and go back to the bus at once, the billing thread
+    # hands them to handler(readings) in batches of up to max_batch, so a slow room
+    # state command never delays the next poll and a slow meter never delays billing.
+    # Above high_water readings put() asks the caller to poll slower. When the ring
+    # is full the oldest reading is dropped and counted: energy billing loses nothing
+    # as the next register reading covers the gap, power billing integrates over the
+    # acquisition stamps, so the gap is billed up to max_sample_gap.
+    def __init__(self, handler, capacity=1024, max_batch=64, high_water=0.75):
+        self.handler = handler
+        self.capacity = capacity
+        self.max_batch = max_batch
+        self.high_water = int(capacity * high_water)
+        self.ring = deque()
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.max_depth = 0
+        self.thread = None
+
+    def put(self, reading):
+        # Returns False when the caller should back off
+        with self.condition:
+            if len(self.ring) >= self.capacity:
+                dropped, _ = self.ring.popleft()
+                self.dropped += 1
+                PIPELINE_DROPPED.inc(room=dropped.room.room_id)
+            self.ring.append((reading, time.perf_counter()))
+            depth = len(self.ring)
+            self.max_depth = max(self.max_depth, depth)
+            self.condition.notify()
+        PIPELINE_DEPTH.set(depth)
+        return depth <= self.high_water
+
+    def take_batch(self):
+        with self.condition:
+            while not self.ring:
+                self.condition.wait()
+            batch = [self.ring.popleft() for _ in range(min(len(self.ring), self.max_batch))]
+            depth = len(self.ring)
+        PIPELINE_DEPTH.set(depth)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.take_batch()
+            batch_start = time.perf_counter()
+            for _, queued_at in batch:
+                PIPELINE_QUEUE_SECONDS.observe(batch_start - queued_at)
+            PIPELINE_BATCH_SIZE.observe(len(batch))
+            try:
+                self.handler([reading for reading, _ in batch])
+            except Exception as e:
+                print("Billing Error: ", e)
+            LOOP_SECONDS.observe(time.perf_counter() - batch_start, loop='billing')
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+class RoomSync:
+    FIREBASE_FIELDS = ["CurrentCredit", "ElectricityPrice", "CreditCriticalLevel"]
+
+    # The Firebase side of one room: the listener cache, credit reconciliation, the
+    # upload cursor and remote retention. room_state is the room's RoomState, or its
+    # RoomMirror in the sync process of the split deployment.
+    # Deductions and samples go to Firebase at most every sync_interval seconds, in the
+    # PowerConsumptionSync layout given by firebase_layout. retention (a RetentionPolicy)
+    # is applied every retention_interval seconds.
+    def __init__(self, room_id, firebase_manager, room_state, watermark_file, clock=SYSTEM_CLOCK, sync_interval=2, firebase_layout='partitioned', retention=None, retention_interval=3600,
+                 move_legacy_history=False):
+        self.room_id = room_id
+        self.firebase_manager = firebase_manager
+        self.room_state = room_state
+        self.clock = clock
+        self.power_sync = PowerConsumptionSync(firebase_manager, room_state, watermark_file, layout=firebase_layout, clock=clock)
+        self.retention = retention or RetentionPolicy()
+        self.retention_interval = retention_interval
+        self.next_retention = 0
+        self.firebase_fields = {}
+        self.sync_interval = sync_interval
+        self.next_sync = 0
+        self.acknowledged_sequence = None
+        self.move_legacy_history = move_legacy_history
+        # Whether Rooms/<room>/PowerConsumption of the legacy layout still exists, None
+        # until checked. The legacy layout writes it, so it always does there.
+        self.legacy_history = True if firebase_layout == 'legacy' else None
+        # Set by CloudSync, woken when a listened field changes
+        self.firebase_event = None
+
+        # Guards the listener cache only, never held across I/O
+        self.local_data_lock = TimedLock(lock='local_data', room=room_id)
+
+    def update_relay(self, power=None):
+        # A mirrored room's relay is switched by the metering process
+        pass
+
+    def apply_local_retention(self, now):
+        # A mirror only needs the samples not uploaded yet and the rest of their day
+        # for the rollups, the metering process prunes the room's local storage
+        samples, _ = self.room_state.samples_since(self.power_sync.position, 1)
+        moment = datetime.fromtimestamp(samples[0][0] if samples else now)
+        self.room_state.prune(moment.replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+    def on_firebase_field(self, field, value):
+        # Listener threads only fill the cache and wake the update loop, which is the
+        # one thread that reconciles and talks to Firebase for this room
+        with self.local_data_lock:
+            self.firebase_fields[field] = value
+        if self.firebase_event is not None:
+            self.firebase_event.set()
+
+    def cached_firebase_data(self):
+        with self.local_data_lock:
+            if all(field in self.firebase_fields for field in self.FIREBASE_FIELDS):
+                return dict(self.firebase_fields)
+            return None
+
+    def apply_firebase_data(self, firebase_data):
+        # Prices and the balance are one room state command
+        self.room_state.modify(firebase_field_changes, firebase_data)
+        now = self.clock.monotonic()
+        if now >= self.next_sync:
+            self.next_sync = now + self.sync_interval
+            self.sync_credit()
+
+    def sync_credit(self):
+        # Pushes the pending deductions as one batch, then uploads new samples and
+        # the LedgerOutbox in one multi-path update. Both are skipped when there is
+        # nothing new, so an idle room makes no requests. A ledger entry stays in the
+        # outbox until an upload carrying it succeeded.
+        pending = self.room_state.get("LedgerPending", 0)
+        sequence = self.room_state.get("LedgerSequence", 0)
+        # A mirror shows an acknowledgement only once the metering process applied it,
+        # until then its pending amount still holds the batch already deducted
+        if pending > 0 and (self.acknowledged_sequence is None or sequence > self.acknowledged_sequence):
             with self.local_data_lock:
-                if firebase_data is not None:
-                    #Fetch specific fields from Firebase
-                    current_credit_firebase = firebase_data['CurrentCredit']
-                    electricity_price = firebase_data['ElectricityPrice']
-                    credit_critical_level = firebase_data['CreditCriticalLevel']
-                    #Reads the Local Json
-                    local_data = self.local_manager.read_local_data()
-                    local_current_credit = self.local_manager.get_room_data(local_data, "CurrentCredit")
-                    #print("__________________________________________________________________")
-                    #print(f"Starting Local Data of Loop: {local_data}")
-                    #print(f"Firebase Current Credit is: {current_credit_firebase}")
-                    #print("Local Current Credit is: ", local_current_credit)
-                    #print("Snapshot Data Is: ", self.snapshot_current_credit)
-
-                    #Checks if Firebase and Local is the Same
-                    if current_credit_firebase != local_current_credit:
-                        #print('Checking for Changes...')
-                    #Checks is the Snapshot is Higher than the Local Data
-                        if self.snapshot_current_credit >= local_current_credit:
-                            # Calculate the difference between snapshot and local JSON CurrentCredit
-                            #print("Calculating Changes on Local: ", self.snapshot_current_credit, " minus ", local_current_credit)
-
-                            difference = self.snapshot_current_credit - local_current_credit
-                            #print(f"Answer Is: {difference}")
-
-                            # Adjust Firebase CurrentCredit with the difference
-                            #print(f"Adjusting Credit: {current_credit_firebase} minus {difference}")
-                            current_credit_firebase -= difference
-                            #print(f"Current Credit Is Now: {current_credit_firebase}")
-
-                    # Update snapshot variable with the adjusted CurrentCredit value
-                    self.snapshot_current_credit = local_current_credit
-                    #print("Snapshot Data now Is: ", self.snapshot_current_credit)
-
-                    # Update local JSON with the adjusted Firebase CurrentCredit
-                    self.local_manager.update_room_data(local_data, "CurrentCredit", current_credit_firebase)
-                    self.local_manager.update_room_data(local_data, "CreditCriticalLevel", credit_critical_level)
-                    self.local_manager.update_room_data(local_data, "ElectricityPrice", electricity_price)
-                    self.local_manager.update_local_data(local_data)
-                    self.firebase_manager.update_firebase_data({"CurrentCredit": current_credit_firebase})
-                    self.firebase_manager.update_firebase_data({"PowerConsumption":  local_data["Rooms"]["Room-1"]["PowerConsumption"]})
-
-    def pzem_to_local_data(self):
+                cached_balance = self.firebase_fields.get("CurrentCredit")
+            # The tagged write carries the whole room node, only used once it is known
+            # to hold no legacy PowerConsumption history
+            batch_sequence = sequence if self.legacy_history_gone() else None
+            result = self.firebase_manager.deduct_credit(pending, self.room_id, batch_sequence)
+            if result is None:
+                return False
+            balance, deduction = result
+            self.room_state.modify(ledger_acknowledgement, deduction, balance, self.clock.time())
+            self.acknowledged_sequence = sequence
+            # Keep the listener cache in step until our own write echoes back,
+            # unless the app changed the balance meanwhile
+            with self.local_data_lock:
+                if self.firebase_fields.get("CurrentCredit") == cached_balance:
+                    self.firebase_fields["CurrentCredit"] = balance
+        ledger_entries = dict(self.room_state.get("LedgerOutbox") or {})
+        if not self.power_sync.sync(ledger_entries=ledger_entries):
+            return False
+        if ledger_entries:
+            self.room_state.modify(ledger_upload, list(ledger_entries))
+        return True
+
+    def maybe_apply_retention(self):
+        # Runs on the update loop thread, so pruning never blocks metering or the owner thread
+        if self.clock.monotonic() < self.next_retention:
+            return
+        self.next_retention = self.clock.monotonic() + self.retention_interval
+        now = self.clock.time()
+        oldest = self.room_state.oldest_sample()
+        oldest = now if oldest is None else min(oldest, now)
+        self.apply_local_retention(now)
+        if self.power_sync.layout == 'partitioned':
+            deletions, pruned_through = self.retention.remote_deletions(self.room_id, now, self.room_state.get("RetentionPrunedThrough"), oldest)
+            # Offline the deletions are simply retried on the next run
+            if not deletions or self.firebase_manager.update_firebase_data(deletions, None):
+                self.room_state.set("RetentionPrunedThrough", pruned_through)
+
+    def legacy_history_gone(self):
+        # True once Firebase confirmed the room node holds no legacy PowerConsumption,
+        # one small query until then
+        if self.legacy_history is None and self.firebase_manager.available():
+            first = self.firebase_manager.get_key_range(f"Rooms/{self.room_id}/PowerConsumption", limit=1)
+            if first is not None:
+                self.legacy_history = bool(first)
+        return self.legacy_history is False
+
+    def maybe_move_legacy_history(self):
+        # With move_legacy_history the partitioned layout moves the legacy layout's
+        # Rooms/<room>/PowerConsumption, which the old app reads, out of the room node
+        # that poll mode fetches, one day per call until the node is gone
+        if not self.move_legacy_history or self.legacy_history is False or not self.firebase_manager.available():
+            return
+        legacy_path = f"Rooms/{self.room_id}/PowerConsumption"
+        first = self.firebase_manager.get_key_range(legacy_path, limit=1)
+        if first is None:
+            return
+        self.legacy_history = bool(first)
+        if not first:
+            return
+        # Legacy keys start with the day, "%m-%d-%Y"
+        prefix = next(iter(first))[:10]
+        try:
+            day = datetime.strptime(prefix, '%m-%d-%Y')
+            legacy = self.firebase_manager.get_key_range(legacy_path, prefix, prefix + '\uf8ff')
+            current = self.firebase_manager.get_key_range(f"PowerConsumption/{self.room_id}/{day:%Y-%m-%d}")
+            if not legacy or current is None:
+                return
+            payload = self.power_sync.legacy_day_payload(day, legacy, current)
+        except ValueError as e:
+            # Left as it is, a key this controller never wrote
+            print("Move Legacy PowerConsumption Error: ", e)
+            self.move_legacy_history = False
+            return
+        if self.firebase_manager.update_firebase_data(payload, None):
+            print("Moved Legacy PowerConsumption Day: ", self.room_id, f"{day:%Y-%m-%d}", len(legacy))
+
+class Room(RoomSync):
+    # Everything one metered room owns: its state shard, relay, meter and Firebase
+    # sync cursor. Rooms share nothing, so a write to one room never locks or
+    # rewrites another room's data.
+    # billing_mode 'power', the default, integrates instantaneous power over the measured
+    # time between samples, 'energy' bills differences of the meter's own energy register,
+    # so samples can be missed or slowed down to idle_sample_interval without losing energy.
+    # 'energy' changes the stored data: sample values are whole 1 Wh register steps, most
+    # readings none at all, and the room keeps the register in an EnergyRegister field.
+    # The poll interval adapts between min_sample_interval on load changes and
+    # idle_sample_interval on flat readings, and flat runs are stored as one sample.
+    # Every reading's full Measurement goes to measurement_log (a MeasurementLog) when given.
+    def __init__(self, room_id, firebase_manager, local_manager, relay, meter, watermark_file, billing_mode='power', sample_interval=1, idle_sample_interval=5, max_sample_gap=10, clock=SYSTEM_CLOCK,
+                 min_sample_interval=0.25, max_run_seconds=60, sync_interval=2, firebase_layout='partitioned', retention=None, retention_interval=3600, measurement_log=None,
+                 move_legacy_history=False):
+        room_state = RoomState(local_manager, clock=clock, history_since=PowerConsumptionSync.history_start(watermark_file))
+        super().__init__(room_id, firebase_manager, room_state, watermark_file, clock=clock, sync_interval=sync_interval,
+                         firebase_layout=firebase_layout, retention=retention, retention_interval=retention_interval, move_legacy_history=move_legacy_history)
+        self.local_manager = local_manager
+        self.measurement_log = measurement_log
+        self.relay = relay
+        self.relay_controller = RelayController(relay, room_id, clock=clock)
+        self.relay_controller.critical_callbacks.append(self.on_credit_critical)
+        self.meter = meter
+        self.billing_mode = billing_mode
+        self.sample_interval = sample_interval
+        self.idle_sample_interval = idle_sample_interval
+        self.max_sample_gap = max_sample_gap
+        self.sampler = AdaptiveSampler(sample_interval, min_sample_interval, idle_sample_interval)
+        self.run_length = RunLengthEncoder(max_run_seconds)
+        self.energy_counter = EnergyCounter(self.room_state.get("EnergyRegister"))
+        self.last_sample_time = None
+        self.sample_count = 0
+        # Monotonic time of the reading the local credit was last billed up to
+        self.billed_at = None
+
+    def update_relay(self, power=None):
+        self.relay_controller.update(self.room_state.get("CurrentCredit", 0), power, self.room_state.get("ElectricityPrice"), self.room_state.get("CreditCriticalLevel"),
+                                     self.billed_at)
+
+    def apply_local_retention(self, now):
+        # Measurements are raw data too and are kept as long as the samples
+        cutoff = self.retention.raw_cutoff(now)
+        if cutoff is not None and self.room_state.prune(cutoff):
+            self.local_manager.prune_samples(cutoff)
+        if cutoff is not None and self.measurement_log is not None:
+            try:
+                self.measurement_log.prune_before(cutoff)
+            except Exception as e:
+                print("Prune Measurements Error: ", e)
+
+    def on_credit_critical(self, room_id, credit, critical_level):
+        print("Credit Critical Level Reached: ", room_id, credit, critical_level)
+
+    def acquire(self, measurement):
+        # Acquisition stage, on the bus thread for every reading: stamps it and picks
+        # the delay until this room's meter should be polled again.
+        # Returns (reading, delay), the reading is billed later by bill_readings.
+        if self.room_state.get("CurrentCredit", 0) <= 0:
+            interval, flat = self.idle_sample_interval, False
+        else:
+            interval, flat = self.sampler.next_interval(measurement.power), self.sampler.flat
+        return Reading(self, self.clock.monotonic(), self.clock.time(), measurement, flat), interval
+
+    def bill_readings(self, readings):
+        # Billing stage, on the pipeline thread: turns a batch of this room's readings
+        # into samples and one deduction, a single room state command for the batch.
+        # Credit is tracked through the batch so readings past exhaustion aren't billed.
+        if self.measurement_log is not None:
+            try:
+                self.measurement_log.append([(reading.timestamp, reading.measurement) for reading in readings])
+            except Exception as e:
+                print("Measurement Log Error: ", e)
+        samples = []
+        consumption = 0
+        credit = self.room_state.get("CurrentCredit", 0)
+        price = self.room_state.get("ElectricityPrice", 0)
+        for reading in readings:
+            if self.billing_mode == 'energy':
+                power_in_kWh = self.energy_counter.delta_kwh(reading.measurement.energy)
+            if credit - consumption * price <= 0:
+                samples += self.run_length.flush()
+                self.last_sample_time = None
+                continue
+            if self.billing_mode == 'power':
+                elapsed = self.sample_interval if self.last_sample_time is None else min(reading.monotonic - self.last_sample_time, self.max_sample_gap)
+                self.last_sample_time = reading.monotonic
+                power_in_kWh = ((reading.measurement.power / 1000) * (elapsed / 3600))
+            power_consumption = round(power_in_kWh, 7)
+            self.sample_count += 1
+
+            if power_consumption > 0:
+                samples += self.run_length.add(reading.timestamp, power_consumption, reading.flat)
+                if self.run_length.run_samples > 1:
+                    SAMPLES_COALESCED.inc(room=self.room_id)
+                consumption += power_consumption
+            else:
+                samples += self.run_length.expire(reading.timestamp)
+        if self.billing_mode == 'energy':
+            self.room_state.set("EnergyRegister", self.energy_counter.last_reading)
+        # Samples and the deduction are one room state command, the flusher persists them
+        self.store_consumption(samples, round(consumption, 7))
+        # Every reading bills what the meter shows up to it, with or without energy
+        self.billed_at = readings[-1].monotonic
+        # Reschedules the predicted cutoff with the new balance and power draw
+        self.update_relay(readings[-1].measurement.power)
+
+    def store_consumption(self, samples, power_consumption):
+        if samples:
+            SAMPLES_RECORDED.inc(len(samples), room=self.room_id)
+        elif power_consumption <= 0:
+            return
+        self.room_state.record_consumption(samples, power_consumption)
+
+class CloudSync:
+    # The Firebase loop over a set of RoomSync rooms, a thread of the controller or
+    # the main loop of the sync process in the split deployment.
+    # firebase_mode 'listen' keeps streaming listeners on the scalar room fields,
+    # 'poll' fetches each whole room with get_firebase_data every loop.
+    def __init__(self, firebase_manager, rooms, firebase_mode='listen', clock=SYSTEM_CLOCK):
+        self.firebase_manager = firebase_manager
+        self.rooms = rooms
+        self.firebase_mode = firebase_mode
+        self.clock = clock
+        self.firebase_event = threading.Event()
+        for room in rooms:
+            room.firebase_event = self.firebase_event
+
+    def listen_rooms(self):
+        # True once every room's listeners are open
+        return all([self.firebase_manager.listen_room_fields(RoomSync.FIREBASE_FIELDS, room.on_firebase_field, room.room_id) for room in self.rooms])
+
+    def handle_updates(self):
+        listening = False
         while True:
-            local_data = self.local_manager.read_local_data()
-            if local_data is not None:
-                if self.local_manager.get_room_data(local_data, "CurrentCredit") > 0:
-                    switch.on()
-                    power = self.pzem_sensor.pzem_sensor_data_read()
-
-                    if power is not None:
-                        power_in_kWh = ((power / 1000) / 3600)
-                        current_datetime = datetime.now().strftime('%m-%d-%Y %H:%M:%S')
-                        power_consumption = round(power_in_kWh, 7)
-
-                        if power_consumption > 0:
-                            # Update local JSON directly
-                            self.local_manager.update_power_consumption(local_data, current_datetime, power_consumption)
-                            electricity_price = self.local_manager.get_room_data(local_data, "ElectricityPrice")
-                            deduction = power_consumption * electricity_price
-                            updated_credit = max(self.local_manager.get_room_data(local_data, "CurrentCredit") - deduction, 0)
-                            self.local_manager.update_room_data(local_data, "CurrentCredit", updated_credit)
-
-                            self.local_manager.update_local_data(local_data)       
+            retry_in = self.firebase_manager.retry_in()
+            if retry_in is None:
+                # Still connecting, only local upkeep such as retention is due
+                self.clock.wait(self.firebase_manager.connected, 5)
+            else:
+                if self.firebase_mode == 'listen' and not listening:
+                    listening = self.listen_rooms()
+                # A listened field change wakes the loop at once, otherwise it runs every
+                # .25 s, or when the breaker lets requests through again while it is open
+                self.clock.wait(self.firebase_event, min(max(retry_in, .25), 5))
+            self.firebase_event.clear()
+            loop_start = time.perf_counter()
+            for room in self.rooms:
+                if self.firebase_mode == 'listen':
+                    firebase_data = room.cached_firebase_data()
+                elif self.firebase_manager.available():
+                    print("InternetCheck")
+                    firebase_data = self.firebase_manager.get_firebase_data(room.room_id)
                 else:
-                    switch.off()
-            time.sleep(1)
-            
+                    firebase_data = None
+                if firebase_data is not None:
+                    room.apply_firebase_data(firebase_data)
+                    # Top-ups reach the relay now instead of on the next meter reading
+                    room.update_relay()
+                room.maybe_apply_retention()
+                room.maybe_move_legacy_history()
+            LOOP_SECONDS.observe(time.perf_counter() - loop_start, loop='firebase')
+
+class SampleRing:
+    # Single-producer single-consumer ring of fixed-size sample records in shared
+    # memory, how the metering process hands samples to the sync process without
+    # pickling them. A slot is a RECORD (room index, global position, epoch, kWh)
+    # followed by the slot's sequence number and a CRC-32 of both. Shared memory has
+    # no ordering guarantee between the processes, on ARM the reader can see the new
+    # sequence before the record, so it copies the whole slot and only takes it when
+    # the sequence is the next one and the CRC matches, otherwise it tries again on
+    # the next take. The header holds how many records were read, the writer never
+    # overwrites one the reader has not taken.
+    # Created before the sync process is forked, both processes map the same memory.
+    RECORD = struct.Struct('<H6xQdd')
+    SEQUENCE = struct.Struct('<Q')
+    CHECKSUM = struct.Struct('<I')
+    HEADER = struct.Struct('<Q')
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.slot_size = self.RECORD.size + self.SEQUENCE.size + self.CHECKSUM.size
+        self.memory = shared_memory.SharedMemory(create=True, size=self.HEADER.size + capacity * self.slot_size)
+        self.written = 0
+        self.read = 0
+        atexit.register(self.unlink)
+
+    def slot_offset(self, count):
+        return self.HEADER.size + (count % self.capacity) * self.slot_size
+
+    def put(self, records):
+        # Writes as many records as there is room for, returns how many
+        read, = self.HEADER.unpack_from(self.memory.buf, 0)
+        count = min(len(records), self.capacity - (self.written - read))
+        for record in records[:count]:
+            offset = self.slot_offset(self.written)
+            self.written += 1
+            payload = self.RECORD.pack(*record) + self.SEQUENCE.pack(self.written)
+            self.memory.buf[offset:offset + self.slot_size] = payload + self.CHECKSUM.pack(zlib.crc32(payload))
+        return count
+
+    def take(self, limit=1024):
+        records = []
+        while len(records) < limit:
+            offset = self.slot_offset(self.read)
+            slot = bytes(self.memory.buf[offset:offset + self.slot_size])
+            sequence, = self.SEQUENCE.unpack_from(slot, self.RECORD.size)
+            checksum, = self.CHECKSUM.unpack_from(slot, self.RECORD.size + self.SEQUENCE.size)
+            if sequence != self.read + 1 or checksum != zlib.crc32(slot[:-self.CHECKSUM.size]):
+                break
+            records.append(self.RECORD.unpack_from(slot))
+            self.read += 1
+        if records:
+            self.HEADER.pack_into(self.memory.buf, 0, self.read)
+        return records
+
+    def depth(self):
+        read, = self.HEADER.unpack_from(self.memory.buf, 0)
+        return self.written - read
+
+    def unlink(self):
+        # Removes the segment's name, the mappings stay valid until both processes exit.
+        # Only the creating process does this, a forked child exits without atexit.
+        try:
+            self.memory.unlink()
+        except FileNotFoundError:
+            pass
+
+class ControlChannel:
+    # One end of the Pipe between the metering and the sync process, messages are
+    # small tuples. Sends from several threads are serialized.
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def send(self, *message):
+        with self.lock:
+            try:
+                self.connection.send(message)
+            except (OSError, ValueError) as e:
+                print("Control Channel Error: ", e)
+
+    def poll(self, timeout=0):
+        return self.connection.poll(timeout)
+
+    def recv(self):
+        return self.connection.recv()
+
+class RoomMirror:
+    # Stand-in for a RoomState in the sync process. Fields and samples arrive from
+    # the metering process's SyncBridge, samples from the start of the day the sync
+    # watermark points into, as the rollups need whole days. Changes go back as
+    # commands on the control channel, modify() only by the name of a
+    # MODIFY_COMMANDS function, and show here once the metering process applied them.
+    def __init__(self, room_id, channel):
+        self.room_id = room_id
+        self.channel = channel
+        self.fields = MappingProxyType({})
+        self.oldest = None
+        self.power_series = None
+        self.end_position = None
+        self.ready = threading.Event()
+        # Guards swapping the series on prune against the receiver's appends
+        self.lock = threading.Lock()
+
+    def subscribe(self, since):
+        self.channel.send("subscribe", self.room_id, since)
+
+    def on_subscribed(self, start_position, end_position):
+        with self.lock:
+            self.power_series = PowerSeries(offset=start_position)
+            self.end_position = end_position
+        if start_position >= end_position:
+            self.ready.set()
+
+    def on_fields(self, fields, oldest):
+        self.fields = MappingProxyType(fields)
+        self.oldest = oldest
+
+    def add_sample(self, position, timestamp, value):
+        with self.lock:
+            # Positions already held are skipped
+            if self.power_series is None or position != len(self.power_series):
+                return
+            self.power_series.append(timestamp, value)
+            if len(self.power_series) >= self.end_position:
+                self.ready.set()
+
+    def get(self, key, default=None):
+        return self.fields.get(key, default)
+
+    def set(self, key, value):
+        self.set_fields({key: value})
+
+    def set_fields(self, fields):
+        self.channel.send("set", self.room_id, fields)
+
+    def modify(self, function, *args):
+        self.channel.send("modify", self.room_id, function.__name__, args)
+
+    def samples_since(self, position, limit=None):
+        power_series = self.power_series
+        sample_count = len(power_series)
+        end = sample_count if limit is None else min(sample_count, position + limit)
+        return power_series.samples(position, end), end
+
+    def total_between(self, start, end):
+        return self.power_series.total_between(start, end)
+
+    def find_sample_position(self, timestamp, position_hint):
+        return self.power_series.find_position(timestamp, position_hint)
+
+    def oldest_sample(self):
+        return self.oldest
+
+    def prune(self, before):
+        with self.lock:
+            power_series = self.power_series.dropped_before(before)
+            dropped = len(self.power_series.timestamps) - len(power_series.timestamps)
+            self.power_series = power_series
+        return dropped
+
+class SyncBridge:
+    # The metering process's end of the split deployment. Publishes each subscribed
+    # room's new samples into the SampleRing and its fields on the control
+    # channel whenever they change, and applies the sync process's commands, so a
+    # stalled Firebase request never holds up a reading or a relay switch.
+    # The metering process owns local storage, local retention runs here.
+    def __init__(self, rooms, ring, channel, clock=SYSTEM_CLOCK, publish_interval=0.1):
+        self.rooms = rooms
+        self.ring = ring
+        self.channel = channel
+        self.clock = clock
+        self.publish_interval = publish_interval
+        self.room_indexes = {room_id: index for index, room_id in enumerate(rooms)}
+        self.positions = {}
+        self.versions = {}
+        # positions are set by the command thread and advanced by the publisher
+        self.lock = threading.Lock()
+
+    def publish(self):
+        for room_id, room in self.rooms.items():
+            snapshot = room.room_state.snapshot
+            if self.versions.get(room_id) != snapshot.version:
+                self.versions[room_id] = snapshot.version
+                # Every field, nested ones like RetentionPrunedThrough included, the
+                # sync process has no other copy of the room's progress
+                self.channel.send("fields", room_id, dict(snapshot.fields), room.room_state.oldest_sample())
+            with self.lock:
+                position = self.positions.get(room_id)
+                if position is None:
+                    continue
+                samples, _ = room.room_state.samples_since(position, self.ring.capacity)
+                records = [(self.room_indexes[room_id], position + index, timestamp, value) for index, (timestamp, value) in enumerate(samples)]
+                self.positions[room_id] = position + self.ring.put(records)
+
+    def handle_command(self, command, room_id, *args):
+        room = self.rooms[room_id]
+        if command == "subscribe":
+            with self.lock:
+                start_position = room.room_state.first_position_at(args[0])
+                self.channel.send("subscribed", room_id, start_position, room.room_state.snapshot.sample_count)
+                self.positions[room_id] = start_position
+        elif command == "modify":
+            name, function_args = args
+            room.room_state.modify(MODIFY_COMMANDS[name], *function_args)
+            # Top-ups reach the relay now instead of on the next meter reading
+            room.update_relay()
+        elif command == "set":
+            room.room_state.set_fields(args[0])
+
+    def run_publisher(self):
+        while True:
+            self.publish()
+            for room in self.rooms.values():
+                if self.clock.monotonic() >= room.next_retention:
+                    room.next_retention = self.clock.monotonic() + room.retention_interval
+                    room.apply_local_retention(self.clock.time())
+            self.clock.sleep(self.publish_interval)
+
+    def run_commands(self):
+        while True:
+            try:
+                message = self.channel.recv()
+            except (EOFError, OSError):
+                print("Sync Process Exited, Metering Continues Offline")
+                return
+            try:
+                self.handle_command(*message)
+            except Exception as e:
+                print("Sync Command Error: ", e)
+
+    def start(self):
+        threading.Thread(target=self.run_publisher, daemon=True).start()
+        threading.Thread(target=self.run_commands, daemon=True).start()
+
+class SyncProcess:
+    # Main of the sync process in the split deployment: owns the Firebase SDK, JSON
+    # encoding and the cloud loop on its own interpreter and core. rooms are
+    # (room_id, watermark_file) pairs in the metering process's order, room_options
+    # go to each RoomSync. firebase_factory() builds the FirebaseManager in this process.
+    def __init__(self, firebase_factory, rooms, ring, connection, firebase_mode='listen', clock=SYSTEM_CLOCK, metrics_port=None, **room_options):
+        self.firebase_factory = firebase_factory
+        self.rooms = rooms
+        self.ring = ring
+        self.channel = ControlChannel(connection)
+        self.firebase_mode = firebase_mode
+        self.clock = clock
+        self.metrics_port = metrics_port
+        self.room_options = room_options
+        self.room_ids = [room_id for room_id, _ in rooms]
+        self.mirrors = {room_id: RoomMirror(room_id, self.channel) for room_id in self.room_ids}
+
+    def receive(self):
+        while True:
+            # Records are taken before the messages are read, so a room's "subscribed"
+            # is always handled before the records that follow it
+            records = self.ring.take()
+            try:
+                while self.channel.poll():
+                    message = self.channel.recv()
+                    mirror = self.mirrors[message[1]]
+                    if message[0] == "fields":
+                        mirror.on_fields(*message[2:])
+                    elif message[0] == "subscribed":
+                        mirror.on_subscribed(*message[2:])
+            except (EOFError, OSError):
+                # The metering process is gone
+                os._exit(0)
+            for room_index, position, timestamp, value in records:
+                self.mirrors[self.room_ids[room_index]].add_sample(position, timestamp, value)
+            if not records:
+                self.channel.poll(0.05)
 
     def run(self):
-        pzem_thread = threading.Thread(target=self.pzem_to_local_data)
-        pzem_thread.start()
-        db_thread = threading.Thread(target=self.handle_updates)
-        db_thread.start()
+        if self.metrics_port is not None:
+            METRICS.serve(self.metrics_port)
+        threading.Thread(target=self.receive, daemon=True).start()
+        for room_id, watermark_file in self.rooms:
+            since = PowerConsumptionSync.history_start(watermark_file)
+            self.mirrors[room_id].subscribe(0 if since is None else since)
+        for mirror in self.mirrors.values():
+            mirror.ready.wait()
+        firebase_manager = self.firebase_factory()
+        rooms = [RoomSync(room_id, firebase_manager, self.mirrors[room_id], watermark_file, clock=self.clock, **self.room_options) for room_id, watermark_file in self.rooms]
+        CloudSync(firebase_manager, rooms, self.firebase_mode, self.clock).handle_updates()
+
+def default_firebase_manager(clock=SYSTEM_CLOCK):
+    return FirebaseManager('/home/capstone/Downloads/econtrollectricity-firebase-adminsdk-r45sa-d9f7151c8b.json', 'https://econtrollectricity-default-rtdb.asia-southeast1.firebasedatabase.app/',
+                           clock=clock)
+
+class ElectricityController:
+    # One entry per metered room. Rooms on the same port share one RS-485 bus and
+    # are polled by that port's BusScheduler, each port gets its own scheduler thread.
+    DEFAULT_ROOMS = [
+        {"room_id": "Room-1", "relay_pin": 17, "port": '/dev/ttyUSB0', "slave_id": 1},
+    ]
+
+    # firebase_mode 'listen' keeps streaming listeners on the scalar room fields,
+    # 'poll' fetches each whole room with get_firebase_data every loop.
+    # sample_interval is the metering period in seconds, readings adapt between
+    # min_sample_interval on load changes and idle_sample_interval when flat.
+    # sync_interval is how often each room pushes deductions and samples to Firebase,
+    # firebase_layout, retention and move_legacy_history are passed on to every Room,
+    # the last moves a legacy Rooms/<room>/PowerConsumption node into the partitioned
+    # layout and is off by default, the old app still reads that node.
+    # firebase_manager, session_factory(port), relay_factory(pin) and clock default to
+    # the real hardware and cloud, the simulator passes its virtual replacements.
+    # metrics_port serves METRICS on localhost for Prometheus, None turns the endpoint off.
+    # Nothing here waits for Firebase, the time from construction to the first recorded
+    # reading is kept as first_sample_seconds and reported when over first_sample_target.
+    # Readings reach billing through a SamplePipeline of pipeline_capacity readings,
+    # billed in batches of up to pipeline_batch.
+    # processes 'split' forks a SyncProcess that owns Firebase, this process keeps the
+    # serial ports and relays. Samples cross in a SampleRing of ring_capacity records,
+    # firebase_factory() builds the FirebaseManager in the child, metrics_port + 1
+    # serves its metrics.
+    # record_measurements keeps every reading's full Measurement in a per-room MeasurementLog.
+    # storage_mode is each room's LocalDataManager storage, 'log', 'sqlite' or 'json'
+    # (the whole TestJson.json, a single room only), codec the Codec name of its files.
+    def __init__(self, rooms=None, firebase_mode='listen', sample_interval=1, max_sample_gap=10, billing_mode='power', idle_sample_interval=5, data_dir='/home/capstone/Downloads',
+                 firebase_manager=None, session_factory=None, relay_factory=None, clock=SYSTEM_CLOCK, metrics_port=9101, min_sample_interval=0.25, max_run_seconds=60,
+                 sync_interval=2, firebase_layout='partitioned', retention=None, first_sample_target=2.0, pipeline_capacity=1024, pipeline_batch=64,
+                 processes='single', firebase_factory=None, ring_capacity=4096, record_measurements=True, storage_mode='log', codec='json-compact', move_legacy_history=False):
+        self.boot_time = time.monotonic()
+        self.first_sample_target = first_sample_target
+        self.first_sample_seconds = None
+        rooms = rooms or self.DEFAULT_ROOMS
+        if storage_mode == 'json' and len(rooms) > 1:
+            raise ValueError("storage_mode 'json' holds a single room")
+        watermark_files = {config["room_id"]: os.path.join(data_dir, f'TestJson_{config["room_id"]}_sync_watermark.json') for config in rooms}
+        self.processes = processes
+        self.sync_process = None
+        self.sync_bridge = None
+        if processes == 'split':
+            # Forked before this process starts any thread of its own
+            ring = SampleRing(ring_capacity)
+            connection, child_connection = multiprocessing.Pipe()
+            sync_process = SyncProcess(firebase_factory or (lambda: default_firebase_manager(clock)), list(watermark_files.items()), ring, child_connection,
+                                       firebase_mode, clock, metrics_port + 1 if metrics_port is not None else None,
+                                       sync_interval=sync_interval, firebase_layout=firebase_layout, retention=retention, move_legacy_history=move_legacy_history)
+            self.sync_process = multiprocessing.get_context('fork').Process(target=sync_process.run, name='ipecs-sync', daemon=True)
+            self.sync_process.start()
+            firebase_manager = None
+        elif firebase_manager is None:
+            firebase_manager = default_firebase_manager(clock)
+        self.firebase_manager = firebase_manager
+        session_factory = session_factory or RtuSession
+        relay_factory = relay_factory or LED
+        self.clock = clock
+        self.firebase_mode = firebase_mode
+        self.rooms = {}
+        self.meter_rooms = {}
+        self.bus_schedulers = {}
+        self.pipeline = SamplePipeline(self.bill_batch, pipeline_capacity, pipeline_batch)
+        for config in rooms:
+            room_id = config["room_id"]
+            port = config.get("port", '/dev/ttyUSB0')
+            if port not in self.bus_schedulers:
+                self.bus_schedulers[port] = BusScheduler(session_factory(port), self.on_meter_reading, config.get("policy", 'round_robin'), clock=clock)
+            scheduler = self.bus_schedulers[port]
+            meter = Pzem004T(port, config.get("slave_id", 1), session=scheduler.session)
+            local_manager = LocalDataManager(os.path.join(data_dir, 'TestJson.json'), os.path.join(data_dir, 'TestJson_backup.json'), storage_mode=storage_mode, room_id=room_id, codec=codec)
+            measurement_log = MeasurementLog(os.path.join(data_dir, f'TestJson_{room_id}_measurements')) if record_measurements else None
+            room = Room(room_id, self.firebase_manager, local_manager, relay_factory(config.get("relay_pin", 17)), meter,
+                        watermark_files[room_id], billing_mode=billing_mode,
+                        sample_interval=sample_interval, idle_sample_interval=idle_sample_interval, max_sample_gap=max_sample_gap, clock=clock,
+                        min_sample_interval=min_sample_interval, max_run_seconds=max_run_seconds, sync_interval=sync_interval,
+                        firebase_layout=firebase_layout, retention=retention, measurement_log=measurement_log, move_legacy_history=move_legacy_history)
+            scheduler.add_meter(meter, poll_interval=sample_interval, priority=config.get("priority", 0), timeout=config.get("timeout", 0.5))
+            self.rooms[room_id] = room
+            self.meter_rooms[meter] = room
+        if processes == 'split':
+            self.sync_bridge = SyncBridge(self.rooms, ring, ControlChannel(connection), clock)
+            self.cloud_sync = None
+        else:
+            self.cloud_sync = CloudSync(self.firebase_manager, list(self.rooms.values()), firebase_mode, clock)
+        self.metrics_port = metrics_port
+        self.connection = False
+        self.start_time = None
+
+    def on_meter_reading(self, meter, measurement):
+        room = self.meter_rooms[meter]
+        reading, delay = room.acquire(measurement)
+        if not self.pipeline.put(reading):
+            PIPELINE_BACKPRESSURE.inc(room=room.room_id)
+            delay = max(delay, room.idle_sample_interval)
+        if self.first_sample_seconds is None:
+            self.first_sample_seconds = time.monotonic() - self.boot_time
+            TIME_TO_FIRST_SAMPLE.set(self.first_sample_seconds)
+            if self.first_sample_seconds > self.first_sample_target:
+                print(f"Slow Startup: First Sample After {self.first_sample_seconds:.2f} s")
+        return delay
+
+    def bill_batch(self, readings):
+        # Bills each room's readings in order, rooms in the order they first appear
+        rooms = {}
+        for reading in readings:
+            rooms.setdefault(reading.room, []).append(reading)
+        for room, room_readings in rooms.items():
+            room.bill_readings(room_readings)
+
+    def rooms_throughput(self):
+        # Metered samples per second over all rooms since run(), the rooms-per-Pi figure
+        elapsed = time.monotonic() - self.start_time if self.start_time is not None else 0
+        samples = sum(room.sample_count for room in self.rooms.values())
+        return {
+            "rooms": len(self.rooms),
+            "samples": samples,
+            "samples_per_second": samples / elapsed if elapsed > 0 else 0,
+        }
+
+    def run(self, daemon=False):
+        # daemon=True lets a caller such as the simulator end the process when it is done
+        self.start_time = time.monotonic()
+        if self.metrics_port is not None:
+            METRICS.serve(self.metrics_port)
+        for room in self.rooms.values():
+            room.update_relay()
+            room.relay_controller.start()
+            flush_thread = threading.Thread(target=room.room_state.run_flusher, daemon=daemon)
+            flush_thread.start()
+        self.pipeline.start()
+        for scheduler in self.bus_schedulers.values():
+            scheduler.start()
+        if self.sync_bridge is not None:
+            self.sync_bridge.start()
+        else:
+            db_thread = threading.Thread(target=self.cloud_sync.handle_updates, daemon=daemon)
+            db_thread.start()
 
 if __name__ == "__main__":
     electricity_controller = ElectricityController()
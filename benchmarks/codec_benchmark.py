@@ -0,0 +1,47 @@
+import argparse
+import time
+
+from common import load_ipecs, real_shaped_data
+
+CODECS = [
+    'json', 'json-compact', 'orjson', 'msgpack',
+    'json-compact+gzip', 'orjson+gzip', 'msgpack+gzip',
+    'json-compact+zstd', 'orjson+zstd', 'msgpack+zstd',
+]
+
+
+def best_time(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode/decode time and size of the LocalDataManager codecs")
+    parser.add_argument('--samples', type=int, nargs='+', default=[1000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    ipecs = load_ipecs()
+    print(f"{'codec':<20}{'samples':>10}{'bytes':>12}{'B/sample':>10}{'encode ms':>12}{'decode ms':>12}")
+    for sample_count in args.samples:
+        data = real_shaped_data(sample_count)
+        for name in CODECS:
+            try:
+                codec = ipecs.Codec(name)
+            except ValueError as e:
+                print(f"{name:<20}skipped: {e}")
+                continue
+            payload = codec.encode(data)
+            encode_time = best_time(lambda: codec.encode(data), args.repeat)
+            decode_time = best_time(lambda: codec.decode(payload), args.repeat)
+            print(f"{name:<20}{sample_count:>10}{len(payload):>12}{len(payload) / sample_count:>10.1f}"
+                  f"{encode_time * 1000:>12.2f}{decode_time * 1000:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_JSON = os.path.join(ROOT, "TestJson.json")
+
+# Benchmarks run as scripts from this directory, the repo root makes the
+# simulation package importable for its controller loader
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from simulation import load_ipecs
+
+
+def real_shaped_data(sample_count, room_id="Room-1"):
+    # TestJson.json with its PowerConsumption history replayed out to sample_count
+    # one-second samples, keeping the real value distribution and key format
+    with open(TEST_JSON, 'r') as f:
+        local_data = json.load(f)
+    room_data = local_data["Rooms"]["Room-1"]
+    values = list(room_data["PowerConsumption"].values())
+    start = datetime(2024, 1, 7, 13, 30, 54)
+    room_data["PowerConsumption"] = {
+        (start + timedelta(seconds=index)).strftime('%m-%d-%Y %H:%M:%S'): values[index % len(values)]
+        for index in range(sample_count)
+    }
+    local_data["Rooms"] = {room_id: room_data}
+    return local_data
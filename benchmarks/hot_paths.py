@@ -0,0 +1,279 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from common import ROOT, load_ipecs, real_shaped_data
+
+BENCHMARKS = ['read_local_data', 'update_local_data', 'create_backup', 'update_power_consumption', 'firebase_payload', 'pzem_decode']
+STORAGE_MODES = ['json', 'log', 'sqlite']
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+# Registers 0-9 of a PZEM-004T reading 230.1 V, 1.234 A, 283.9 W, 1234567 Wh
+PZEM_REGISTERS = (2301, 1234, 0, 2839, 0, 54919, 18, 500, 950, 0)
+
+
+class NullOutput:
+    # The controller prints on every sample. Printing goes to this sink instead of a
+    # terminal so the numbers measure the code, not the terminal.
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class ConstantSession:
+    # Answers every request with the same registers, so only the decode path is timed
+    reopen_count = 0
+
+    def execute(self, slave_id, function_code, address, quantity, timeout=None):
+        return PZEM_REGISTERS
+
+
+def written_bytes():
+    # Bytes this process has passed to write() so far (Linux only), covers the json
+    # files, the sample log and SQLite alike
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        return revision + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(times, fraction):
+    return times[min(len(times) - 1, int(len(times) * fraction))]
+
+
+def timed_loop(function, iterations, finish=None):
+    # Returns (latencies in seconds, bytes written) of iterations calls to function(index).
+    # finish runs untimed before the bytes are counted, e.g. to commit deferred writes.
+    times = []
+    start_bytes = written_bytes()
+    for index in range(iterations):
+        start = time.perf_counter()
+        function(index)
+        times.append(time.perf_counter() - start)
+    if finish is not None:
+        finish()
+    end_bytes = written_bytes()
+    return times, (end_bytes - start_bytes if start_bytes is not None else None)
+
+
+def result(benchmark, storage_mode, history_samples, times, samples_per_call, bytes_written=None):
+    # samples_per_call is how many samples one call reads or records, bytes are
+    # reported per sample so json rewrites and log appends compare directly
+    total = sum(times)
+    sorted_times = sorted(times)
+    samples = samples_per_call * len(times)
+    return {
+        "benchmark": benchmark,
+        "storage_mode": storage_mode,
+        "history_samples": history_samples,
+        "iterations": len(times),
+        "samples_per_second": samples / total if total > 0 else None,
+        "p50_ms": percentile(sorted_times, 0.50) * 1000,
+        "p99_ms": percentile(sorted_times, 0.99) * 1000,
+        "bytes_per_sample": bytes_written / samples if bytes_written is not None and samples else None,
+    }
+
+
+class Fixture:
+    # A temporary data directory holding a TestJson.json with history_samples samples,
+    # and one LocalDataManager per storage mode built on it
+    def __init__(self, ipecs, history_samples):
+        self.ipecs = ipecs
+        self.history_samples = history_samples
+        self.data_dir = tempfile.mkdtemp(prefix='ipecs-bench-')
+        self.json_file = os.path.join(self.data_dir, 'TestJson.json')
+        self.backup_file = os.path.join(self.data_dir, 'TestJson_backup.json')
+        self.local_data = real_shaped_data(history_samples)
+        ipecs.atomic_write(self.json_file, ipecs.Codec().encode(self.local_data))
+        shutil.copyfile(self.json_file, self.backup_file)
+        self.managers = {}
+        self.next_epoch = ipecs.timestamp_to_epoch(max(self.local_data["Rooms"]["Room-1"]["PowerConsumption"])) + 1
+
+    def manager(self, storage_mode):
+        if storage_mode not in self.managers:
+            self.managers[storage_mode] = self.ipecs.LocalDataManager(self.json_file, self.backup_file, storage_mode=storage_mode)
+        return self.managers[storage_mode]
+
+    def new_timestamp(self):
+        # A fresh one-second key after everything already recorded
+        self.next_epoch += 1
+        return self.ipecs.epoch_to_timestamp(self.next_epoch)
+
+    def close(self):
+        for manager in self.managers.values():
+            if manager.storage_mode == 'sqlite':
+                manager.sqlite_store.close()
+            elif manager.storage_mode == 'log':
+                manager.sample_log.close()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+
+def bench_read_local_data(fixture, storage_mode, args):
+    manager = fixture.manager(storage_mode)
+    times, _ = timed_loop(lambda index: manager.read_local_data(), args.repeat)
+    return result('read_local_data', storage_mode, fixture.history_samples, times, fixture.history_samples)
+
+
+def commit_deferred(manager):
+    # SQLite batches commits, the writes only reach the file on commit
+    if manager.storage_mode == 'sqlite':
+        return manager.sqlite_store.commit
+    return None
+
+
+def bench_update_local_data(fixture, storage_mode, args):
+    # The original per-sample loop: record one sample, then persist the room
+    manager = fixture.manager(storage_mode)
+    local_data = fixture.local_data
+
+    def record(index):
+        manager.update_power_consumption(local_data, fixture.new_timestamp(), 0.0001)
+        manager.update_local_data(local_data)
+
+    times, bytes_written = timed_loop(record, args.repeat, commit_deferred(manager))
+    return result('update_local_data', storage_mode, fixture.history_samples, times, 1, bytes_written)
+
+
+def bench_create_backup(fixture, storage_mode, args):
+    manager = fixture.manager(storage_mode)
+    times, bytes_written = timed_loop(lambda index: manager.create_backup(), args.repeat)
+    return result('create_backup', storage_mode, fixture.history_samples, times, fixture.history_samples, bytes_written)
+
+
+def bench_update_power_consumption(fixture, storage_mode, args):
+    manager = fixture.manager(storage_mode)
+    local_data = fixture.local_data
+    timestamps = [fixture.new_timestamp() for _ in range(args.iterations)]
+    times, bytes_written = timed_loop(lambda index: manager.update_power_consumption(local_data, timestamps[index], 0.0001), args.iterations,
+                                      commit_deferred(manager))
+    return result('update_power_consumption', storage_mode, fixture.history_samples, times, 1, bytes_written)
+
+
+def bench_firebase_payload(fixture, storage_mode, args):
+    # Steady state of the sync loop: one new sample, then the multi-path update for
+    # everything past the watermark. Bytes are the JSON body sent to Firebase.
+    ipecs = fixture.ipecs
+    room_state = ipecs.RoomState(fixture.manager(storage_mode))
+    power_sync = ipecs.PowerConsumptionSync(None, room_state, os.path.join(fixture.data_dir, 'watermark.json'))
+    power_sync.position = len(room_state.power_series)
+    fields = {"CurrentCredit": 100.0}
+    sent_bytes = [0]
+
+    def sync(index):
+        room_state.add_power_consumption(fixture.next_epoch + index, 0.0001).result()
+        samples, position = room_state.samples_since(power_sync.position, power_sync.max_batch)
+        payload = power_sync.build_payload(samples, fields)
+        sent_bytes[0] += len(json.dumps(payload))
+        power_sync.position = position
+
+    times, _ = timed_loop(sync, args.iterations)
+    fixture.next_epoch += args.iterations
+    return result('firebase_payload', storage_mode, fixture.history_samples, times, 1, sent_bytes[0])
+
+
+def bench_pzem_decode(ipecs, args):
+    meter = ipecs.Pzem004T(None, session=ConstantSession())
+    times, _ = timed_loop(lambda index: meter.pzem_sensor_data_read(), args.iterations)
+    return result('pzem_decode', None, None, times, 1)
+
+
+HISTORY_BENCHMARKS = {
+    'read_local_data': bench_read_local_data,
+    'update_local_data': bench_update_local_data,
+    'create_backup': bench_create_backup,
+    'update_power_consumption': bench_update_power_consumption,
+    'firebase_payload': bench_firebase_payload,
+}
+
+
+def print_table(results, baseline=None):
+    # baseline maps (benchmark, storage_mode, history_samples) to an older result
+    header = f"{'benchmark':<26}{'mode':<8}{'history':>10}{'samples/s':>14}{'p50 ms':>11}{'p99 ms':>11}{'B/sample':>12}"
+    print(header + (f"{'p50 vs base':>13}" if baseline is not None else ""))
+    for entry in results:
+        line = (f"{entry['benchmark']:<26}{entry['storage_mode'] or '-':<8}{entry['history_samples'] or '-':>10}"
+                f"{entry['samples_per_second'] or 0:>14.0f}{entry['p50_ms']:>11.3f}{entry['p99_ms']:>11.3f}"
+                + (f"{entry['bytes_per_sample']:>12.1f}" if entry['bytes_per_sample'] is not None else f"{'-':>12}"))
+        if baseline is not None:
+            old = baseline.get((entry['benchmark'], entry['storage_mode'], entry['history_samples']))
+            line += f"{old['p50_ms'] / entry['p50_ms']:>12.2f}x" if old and entry['p50_ms'] else f"{'-':>13}"
+        print(line)
+
+
+def load_baseline(path):
+    with open(path, 'r') as f:
+        document = json.load(f)
+    return {(entry['benchmark'], entry['storage_mode'], entry['history_samples']): entry for entry in document["results"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Samples/s, p50/p99 latency and bytes written per sample of the metering and sync hot paths")
+    parser.add_argument('--samples', type=int, nargs='+', default=[1000, 10000, 100000, 1000000],
+                        help="history sizes to run against, e.g. 1000 10000000")
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument('--storage-modes', nargs='+', choices=STORAGE_MODES, default=STORAGE_MODES)
+    parser.add_argument('--repeat', type=int, default=5, help="calls of the whole-history operations")
+    parser.add_argument('--iterations', type=int, default=2000, help="calls of the per-sample operations")
+    parser.add_argument('--output', help="results JSON file, default benchmarks/results/hot_paths-<time>.json")
+    parser.add_argument('--baseline', help="results JSON file of an earlier run to compare p50 against")
+    args = parser.parse_args()
+
+    ipecs = load_ipecs()
+    results = []
+    with contextlib.redirect_stdout(NullOutput()):
+        if 'pzem_decode' in args.benchmarks:
+            results.append(bench_pzem_decode(ipecs, args))
+        for history_samples in args.samples:
+            fixture = Fixture(ipecs, history_samples)
+            try:
+                for storage_mode in args.storage_modes:
+                    for benchmark in args.benchmarks:
+                        if benchmark in HISTORY_BENCHMARKS and not (benchmark == 'create_backup' and storage_mode != 'json'):
+                            results.append(HISTORY_BENCHMARKS[benchmark](fixture, storage_mode, args))
+            finally:
+                fixture.close()
+
+    document = {
+        "suite": "hot_paths",
+        "created": datetime.now().isoformat(timespec='seconds'),
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "arguments": vars(args),
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"hot_paths-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(document, f, indent=4)
+
+    print_table(results, load_baseline(args.baseline) if args.baseline else None)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from codec_benchmark import best_time
+from common import load_ipecs
+
+from reports import UsageReport, load_history
+from reports.history import SAMPLE_DTYPE, UNITS_PER_KWH
+
+
+def write_year(ipecs, data_dir, days, room_id="Room-1", price=10.0, seed=1):
+    # days of one-second samples in the controller's log storage: a daily load
+    # shape around an idle base, plus noise and a few appliance spikes
+    base = os.path.join(data_dir, 'TestJson_' + room_id)
+    ipecs.CheckpointStore(base + '_checkpoint.json').save(ipecs.Codec().encode({"Rooms": {room_id: {"ElectricityPrice": price}}}))
+    sample_log = ipecs.SampleLog(base + '_segments')
+    per_segment = sample_log.segment_size // SAMPLE_DTYPE.itemsize
+    rng = np.random.default_rng(seed)
+    start = time.mktime((2024, 1, 1, 0, 0, 0, 0, 0, -1))
+    count = days * 86400
+    for index, first in enumerate(range(0, count, per_segment)):
+        seconds = np.arange(first, min(first + per_segment, count), dtype=np.float64)
+        watts = 80 + 400 * np.clip(np.sin((seconds % 86400) / 86400 * 2 * np.pi - 1.5), 0, None) + rng.normal(0, 10, len(seconds))
+        watts += 1500 * (rng.random(len(seconds)) < 0.001)
+        records = np.empty(len(seconds), dtype=SAMPLE_DTYPE)
+        records['timestamp'] = start + seconds
+        records['units'] = np.rint(np.clip(watts, 0, None) / 3600000 * UNITS_PER_KWH)
+        records.tofile(sample_log.segment_path(index))
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load and analysis time of the usage report on synthetic one-second history")
+    parser.add_argument('--days', type=int, nargs='+', default=[30, 365])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    ipecs = load_ipecs()
+    print(f"{'days':>6}{'samples':>12}{'load ms':>10}{'report ms':>11}{'total ms':>10}")
+    for days in args.days:
+        data_dir = tempfile.mkdtemp(prefix='ipecs-report-')
+        try:
+            count = write_year(ipecs, data_dir, days)
+            load_time = best_time(lambda: load_history(ipecs, data_dir), args.repeat)
+            history = load_history(ipecs, data_dir)
+            report_time = best_time(lambda: UsageReport(history).tables(), args.repeat)
+            print(f"{days:>6}{count:>12}{load_time * 1000:>10.0f}{report_time * 1000:>11.0f}{(load_time + report_time) * 1000:>10.0f}")
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+from simulation import load_ipecs
+
+from .history import UsageHistory, load_history
+from .usage import UsageReport
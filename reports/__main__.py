@@ -0,0 +1,115 @@
+import argparse
+import csv
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from . import UsageReport, load_history, load_ipecs
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Text form of the time columns, to the precision that matters for each table
+TIME_UNITS = {'hourly': 'm', 'daily': 'D', 'monthly': 'M', 'peaks': 'm'}
+
+
+def write_csv(path, table, time_unit=None):
+    # Times as text, kWh and money to the 7 decimals samples are stored with
+    columns = {}
+    for name, column in table.items():
+        if column.dtype.kind == 'M':
+            column = np.datetime_as_string(column.astype(f'datetime64[{time_unit}]'))
+        elif column.dtype.kind == 'f':
+            column = np.round(column, 7)
+        columns[name] = column.tolist()
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(zip(*columns.values()))
+
+
+def write_parquet(path, table, time_unit=None):
+    columns = {name: column.astype('datetime64[s]') if column.dtype.kind == 'M' else column for name, column in table.items()}
+    pyarrow.parquet.write_table(pyarrow.table(columns), path)
+
+
+EXPORTERS = {'csv': write_csv, 'parquet': write_parquet}
+
+
+def print_report(report, tables, top):
+    summary = report.summary()
+    print(f"{summary['room']}: {summary['start']} to {summary['end']}, {summary['samples']} samples over {summary['covered_hours']:.1f} h")
+    print(f"  Energy {summary['kwh']:.3f} kWh, cost {summary['cost']:.2f} at {summary['price']} per kWh")
+    print(f"  Peak demand {summary['peak_kw']:.3f} kW at {summary['peak_start']}")
+    print(f"  Idle baseline {summary['baseline_kw']:.3f} kW, {summary['baseline_share'] * 100:.1f}% of energy")
+    print(f"  {'month':<10}{'kWh':>12}{'cost':>12}{'peak kW':>10}{'avg kW':>10}")
+    monthly = tables['monthly']
+    for index in range(len(monthly['start'])):
+        print(f"  {str(monthly['start'][index]):<10}{monthly['kwh'][index]:>12.3f}{monthly['cost'][index]:>12.2f}"
+              f"{monthly['peak_kw'][index]:>10.3f}{monthly['average_kw'][index]:>10.3f}")
+    print(f"  Top {top} peaks ({report.window // 60} min demand)")
+    peaks = tables['peaks']
+    for index in range(len(peaks['start'])):
+        print(f"    {np.datetime_as_string(peaks['start'][index].astype('datetime64[m]'))}{peaks['demand_kw'][index]:>10.3f} kW")
+    load_duration = tables['load_duration']
+    print("  Load duration " + "  ".join(f"{percent:.0f}%: {demand:.3f} kW" for percent, demand in
+                                         zip(load_duration['percent_of_time'][::25], load_duration['demand_kw'][::25])))
+
+
+def parse_date(text):
+    # A local calendar date as epoch seconds
+    return datetime.strptime(text, '%Y-%m-%d').timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="kWh, cost, peak demand and idle baseline per hour, day and month from the local PowerConsumption history")
+    parser.add_argument('--data-dir', default='/home/capstone/Downloads', help="the controller's data_dir")
+    parser.add_argument('--rooms', nargs='+', default=["Room-1"])
+    parser.add_argument('--storage-mode', choices=['log', 'sqlite', 'json'], default='log')
+    parser.add_argument('--since', type=parse_date, help="first local date included, YYYY-MM-DD")
+    parser.add_argument('--until', type=parse_date, help="first local date left out, YYYY-MM-DD")
+    parser.add_argument('--price', type=float, default=None, help="price per kWh, the room's ElectricityPrice by default")
+    parser.add_argument('--window', type=int, default=900, help="demand interval in seconds, has to divide an hour")
+    parser.add_argument('--baseline-percentile', type=float, default=10.0, help="percentile of window demand taken as the idle baseline")
+    parser.add_argument('--max-gap', type=float, default=3600.0, help="seconds between samples above which the time counts as an outage")
+    parser.add_argument('--top', type=int, default=10, help="number of peak demand windows listed")
+    parser.add_argument('--export', choices=sorted(EXPORTERS), help="write every table of every room to --output")
+    parser.add_argument('--output', default='.', help="export directory")
+    args = parser.parse_args()
+    if 3600 % args.window:
+        parser.error("--window has to divide 3600")
+    if args.export == 'parquet' and pyarrow is None:
+        parser.error("parquet export needs pyarrow, pip install pyarrow")
+
+    ipecs = load_ipecs()
+    for room_id in args.rooms:
+        start = time.perf_counter()
+        try:
+            history = load_history(ipecs, args.data_dir, room_id, args.storage_mode).between(args.since, args.until)
+        except (OSError, ValueError) as e:
+            print("Report Error: ", e)
+            continue
+        if not len(history):
+            print(f"{room_id}: no samples")
+            continue
+        loaded = time.perf_counter()
+        report = UsageReport(history, args.price, args.window, args.baseline_percentile, args.max_gap)
+        tables = report.tables(args.top)
+        computed = time.perf_counter()
+        print_report(report, tables, args.top)
+        print(f"  Loaded in {(loaded - start) * 1000:.0f} ms, computed in {(computed - loaded) * 1000:.0f} ms")
+        if args.export:
+            os.makedirs(args.output, exist_ok=True)
+            for name in tables:
+                path = os.path.join(args.output, f"{room_id}_{name}.{args.export}")
+                EXPORTERS[args.export](path, tables[name], TIME_UNITS.get(name))
+            print(f"  Exported {', '.join(tables)} to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
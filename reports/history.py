@@ -0,0 +1,117 @@
+import itertools
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+# SampleLog.RECORD '<dq' as a NumPy record: epoch seconds and an integer count of
+# 1e-7 kWh, so binary segments are read straight into an array
+SAMPLE_DTYPE = np.dtype([('timestamp', '<f8'), ('units', '<i8')])
+UNITS_PER_KWH = 10000000
+
+
+class UsageHistory:
+    # One room's PowerConsumption history as NumPy arrays, timestamps (epoch
+    # seconds, ascending) and units, the energy of each sample in units of
+    # kwh_per_unit, and its scalar room fields (CurrentCredit, ElectricityPrice, ...).
+    # The sample log's integer 1e-7 kWh counts are used as they are, summing them
+    # is exact and saves converting every sample to float.
+    def __init__(self, room_id, timestamps, units, fields=None, kwh_per_unit=1.0):
+        order = None
+        if len(timestamps) > 1 and np.any(timestamps[1:] < timestamps[:-1]):
+            # The clock stepped back at some point, the aggregates need time order
+            order = np.argsort(timestamps, kind='stable')
+        self.room_id = room_id
+        self.timestamps = timestamps if order is None else timestamps[order]
+        self.units = units if order is None else units[order]
+        self.fields = fields or {}
+        self.kwh_per_unit = kwh_per_unit
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def between(self, start=None, end=None):
+        # The samples with start <= timestamp < end, as views of the same arrays
+        first = 0 if start is None else np.searchsorted(self.timestamps, start, side='left')
+        last = len(self.timestamps) if end is None else np.searchsorted(self.timestamps, end, side='left')
+        return UsageHistory(self.room_id, self.timestamps[first:last], self.units[first:last], self.fields, self.kwh_per_unit)
+
+
+def read_sample_log(ipecs, log_dir):
+    # Binary segments are read into one preallocated SAMPLE_DTYPE array, a torn last
+    # record is left out like SampleLog.read_segment does. Legacy .log segments go
+    # through read_segment record by record. Returns timestamps and 1e-7 kWh units.
+    sample_log = ipecs.SampleLog(log_dir)
+    legacy_timestamps, legacy_units, segments = [], [], []
+    for index in sample_log.list_segments():
+        if os.path.exists(sample_log.legacy_path(index)):
+            records = [(ipecs.timestamp_to_epoch(timestamp) if isinstance(timestamp, str) else timestamp, value)
+                       for timestamp, value in sample_log.read_segment(index)]
+            legacy_timestamps.extend(timestamp for timestamp, _ in records)
+            legacy_units.extend(round(value * UNITS_PER_KWH) for _, value in records)
+            continue
+        path = sample_log.segment_path(index)
+        segments.append((path, os.path.getsize(path) // SAMPLE_DTYPE.itemsize))
+    records = np.empty(sum(count for _, count in segments), dtype=SAMPLE_DTYPE)
+    buffer = memoryview(records).cast('B')
+    position = 0
+    for path, count in segments:
+        with open(path, 'rb') as f:
+            # Only the records there were when sized, the controller may be appending
+            read = f.readinto(buffer[position:position + count * SAMPLE_DTYPE.itemsize])
+        position += read - read % SAMPLE_DTYPE.itemsize
+    records = records[:position // SAMPLE_DTYPE.itemsize]
+    timestamps, units = records['timestamp'], records['units']
+    if legacy_timestamps:
+        timestamps = np.concatenate([np.array(legacy_timestamps, dtype=np.float64), timestamps])
+        units = np.concatenate([np.array(legacy_units, dtype=np.int64), units])
+    return timestamps, units
+
+
+def load_log_history(ipecs, data_dir, room_id):
+    # storage_mode 'log', the files ElectricityController writes per room
+    base = os.path.join(data_dir, 'TestJson_' + room_id)
+    if not os.path.isdir(base + '_segments'):
+        raise FileNotFoundError(f"No sample log for {room_id} in {data_dir}")
+    fields = {}
+    payload = ipecs.CheckpointStore(base + '_checkpoint.json').load()
+    if payload is not None:
+        fields = dict(ipecs.Codec().decode(payload).get("Rooms", {}).get(room_id, {}))
+        fields.pop("PowerConsumption", None)
+    timestamps, units = read_sample_log(ipecs, base + '_segments')
+    return UsageHistory(room_id, timestamps, units, fields, 1 / UNITS_PER_KWH)
+
+
+def load_sqlite_history(ipecs, data_dir, room_id):
+    # storage_mode 'sqlite', opened read-only so a running controller is undisturbed
+    db_file = os.path.join(data_dir, 'TestJson_' + room_id + '.sqlite3')
+    if not os.path.exists(db_file):
+        raise FileNotFoundError(f"No database for {room_id} in {data_dir}")
+    connection = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    try:
+        fields = {key: json.loads(value) for key, value in connection.execute("SELECT key, value FROM room_fields")}
+        rows = connection.execute("SELECT ts_ms, value FROM samples ORDER BY ts_ms")
+        samples = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.float64).reshape(-1, 2)
+    finally:
+        connection.close()
+    return UsageHistory(room_id, samples[:, 0] / 1000, samples[:, 1], fields)
+
+
+def load_json_history(ipecs, data_dir, room_id):
+    # storage_mode 'json', the whole TestJson.json through LocalDataManager
+    local_manager = ipecs.LocalDataManager(os.path.join(data_dir, 'TestJson.json'), os.path.join(data_dir, 'TestJson_backup.json'), room_id=room_id)
+    fields, power_series = local_manager.read_room()
+    return UsageHistory(room_id, np.frombuffer(power_series.timestamps, dtype=np.float64),
+                        np.frombuffer(power_series.values, dtype=np.float64), fields)
+
+
+HISTORY_LOADERS = {
+    'log': load_log_history,
+    'sqlite': load_sqlite_history,
+    'json': load_json_history,
+}
+
+
+def load_history(ipecs, data_dir, room_id="Room-1", storage_mode='log'):
+    return HISTORY_LOADERS[storage_mode](ipecs, data_dir, room_id)
@@ -0,0 +1,188 @@
+import time
+
+import numpy as np
+
+PERIOD_UNITS = {'hour': 'h', 'day': 'D', 'month': 'M'}
+
+
+class UsageReport:
+    # Billing and demand analytics of a UsageHistory, all NumPy array operations.
+    # Samples are first summed into demand windows of window seconds (15 minutes by
+    # default, the usual interval demand is billed on), every other figure is
+    # computed from those few thousand windows instead of the raw samples:
+    #   periods      kWh, cost, peak and average kW per local hour, day or month
+    #   peaks        the top windows by demand
+    #   load_duration  demand exceeded for each percent of the covered time
+    #   baseline     idle demand, the baseline_percentile of the window demands
+    # A sample holds the energy used since the sample before it, so it is spread
+    # evenly over that span. The controller stores no sample while no energy is used,
+    # a sample at the latest after each 1 Wh register step or 60 s flat run, so only
+    # a span longer than max_gap seconds is a gap in the history (meter or controller
+    # down). The default hour covers loads down to 1 W. Demand is the energy of the
+    # covered spans over the covered time, windows without covered time stay out of
+    # the demand statistics and the energy of a gap still counts in kWh. Hours, days and
+    # months are in the Pi's local time, as the PowerConsumption keys are.
+    def __init__(self, history, price=None, window=900, baseline_percentile=10, max_gap=3600):
+        if 3600 % window:
+            raise ValueError("window has to divide an hour")
+        self.history = history
+        self.price = history.fields.get("ElectricityPrice", 0) if price is None else price
+        self.window = window
+        self.baseline_percentile = baseline_percentile
+        self.max_gap = max_gap
+        self.energy = np.empty(0)
+        self.covered_energy = np.empty(0)
+        self.coverage = np.empty(0)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.starts = np.empty(0, dtype=np.int64)
+        self.local_starts = np.empty(0, dtype='datetime64[s]')
+        if len(history):
+            self.bin_windows()
+
+    def bin_windows(self):
+        # Windows are (start, start + window], like the spans. The energy and covered
+        # seconds of a window are the differences of their running totals at its
+        # bounds: the totals of the samples up to the bound, found by one searchsorted
+        # over the time ordered history, plus the share of the span the bound cuts.
+        # The first sample's span is unknown, it counts whole in its window.
+        timestamps = self.history.timestamps
+        units = self.history.units
+        first = int(np.ceil(timestamps[0] / self.window)) - 1
+        last = int(np.ceil(timestamps[-1] / self.window)) - 1
+        self.starts = np.arange(first, last + 1, dtype=np.int64) * self.window
+        bounds = np.append(self.starts, self.starts[-1] + self.window).astype(np.float64)
+        index = np.searchsorted(timestamps, bounds, side='right')
+        self.counts = np.diff(index)
+        # Units summed per window in one reduceat pass, exact for the integer counts.
+        # reduceat gives an empty slice the value at its index, those windows are zero.
+        window_units = np.where(self.counts > 0, np.add.reduceat(units, index[:-1]), 0)
+        energy = np.concatenate(([0], np.cumsum(window_units))).astype(np.float64)
+        # Covered time up to a sample is the time since the first one less the spans
+        # longer than max_gap, which are few. The energy of those spans and of the
+        # first sample is left out of the covered energy the demand is taken from.
+        long_spans = np.flatnonzero(np.diff(timestamps) > self.max_gap) + 1
+        uncovered = np.concatenate(([0], long_spans))
+        uncovered_units = np.concatenate(([0], np.cumsum(units[uncovered])))
+        covered_energy = energy - uncovered_units[np.searchsorted(uncovered, index, side='left')]
+        long_time = np.concatenate(([0.0], np.cumsum(timestamps[long_spans] - timestamps[long_spans - 1])))
+        before = np.maximum(index - 1, 0)
+        coverage = timestamps[before] - timestamps[0] - long_time[np.searchsorted(long_spans, before, side='right')]
+        # A bound inside the span of the sample after it adds that span's share
+        inside = np.flatnonzero((index > 0) & (index < len(timestamps)))
+        following = index[inside]
+        elapsed = bounds[inside] - timestamps[following - 1]
+        span = timestamps[following] - timestamps[following - 1]
+        share = np.divide(elapsed, span, out=np.zeros(len(inside)), where=span > 0)
+        energy[inside] += units[following] * share
+        covered_energy[inside] += np.where(span <= self.max_gap, units[following] * share, 0.0)
+        coverage[inside] += np.where(span <= self.max_gap, elapsed, 0.0)
+        self.energy = np.diff(energy) * self.history.kwh_per_unit
+        self.covered_energy = np.diff(covered_energy) * self.history.kwh_per_unit
+        self.coverage = np.diff(coverage)
+        # The UTC offset only changes on the hour, one localtime() call per hour
+        hours = self.starts // 3600
+        offsets = np.array([time.localtime(hour * 3600).tm_gmtoff for hour in range(int(hours[0]), int(hours[-1]) + 1)], dtype=np.int64)
+        self.local_starts = (self.starts + offsets[hours - hours[0]]).astype('datetime64[s]')
+
+    @property
+    def demand(self):
+        # Average kW over the covered time of each window, a window the history only
+        # partly covers is not diluted by the time it has no samples for
+        return np.divide(self.covered_energy * 3600, self.coverage, out=np.zeros(len(self.coverage)), where=self.coverage > 0)
+
+    @property
+    def covered(self):
+        return self.coverage > 0
+
+    def total_kwh(self):
+        return float(self.energy.sum())
+
+    def covered_hours(self):
+        return float(self.coverage.sum()) / 3600
+
+    def periods(self, period):
+        # Columns of one row per local hour, day or month with samples or energy
+        labels = self.local_starts.astype(f'datetime64[{PERIOD_UNITS[period]}]')
+        start, inverse = np.unique(labels, return_inverse=True)
+        covered = self.covered
+        energy = np.bincount(inverse, weights=self.energy, minlength=len(start))
+        samples = np.bincount(inverse, weights=self.counts, minlength=len(start)).astype(np.int64)
+        covered_energy = np.bincount(inverse, weights=self.covered_energy, minlength=len(start))
+        hours = np.bincount(inverse, weights=self.coverage, minlength=len(start)) / 3600
+        peak = np.zeros(len(start))
+        np.maximum.at(peak, inverse[covered], self.demand[covered])
+        keep = (samples > 0) | (energy > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            average = np.where(hours > 0, covered_energy / hours, 0.0)
+        return {
+            "start": start[keep],
+            "kwh": energy[keep],
+            "cost": energy[keep] * self.price,
+            "peak_kw": peak[keep],
+            "average_kw": average[keep],
+            "covered_hours": hours[keep],
+            "samples": samples[keep],
+        }
+
+    def peaks(self, top=10):
+        # The top windows by demand, highest first
+        candidates = np.flatnonzero(self.covered)
+        demand = self.demand[candidates]
+        if len(candidates) > top:
+            chosen = np.argpartition(demand, -top)[-top:]
+            candidates, demand = candidates[chosen], demand[chosen]
+        order = np.argsort(demand, kind='stable')[::-1]
+        candidates = candidates[order]
+        return {
+            "start": self.local_starts[candidates],
+            "demand_kw": demand[order],
+            "kwh": self.energy[candidates],
+        }
+
+    def load_duration(self, steps=100):
+        # Demand met or exceeded for percent of the covered time, 0 being the peak
+        percent = np.linspace(0, 100, steps + 1)
+        demand = self.demand[self.covered]
+        return {
+            "percent_of_time": percent,
+            "hours": percent / 100 * self.covered_hours(),
+            "demand_kw": np.quantile(demand, 1 - percent / 100) if len(demand) else np.zeros(len(percent)),
+        }
+
+    def baseline(self):
+        # Idle demand in kW, and the share of all energy it accounts for
+        demand = self.demand[self.covered]
+        if not len(demand):
+            return 0.0, 0.0
+        baseline_kw = float(np.percentile(demand, self.baseline_percentile))
+        total = self.total_kwh()
+        return baseline_kw, (baseline_kw * self.covered_hours() / total if total > 0 else 0.0)
+
+    def tables(self, top=10):
+        # Every table of the report by name, as written by the report CLI
+        return {
+            "hourly": self.periods('hour'),
+            "daily": self.periods('day'),
+            "monthly": self.periods('month'),
+            "peaks": self.peaks(top),
+            "load_duration": self.load_duration(),
+        }
+
+    def summary(self):
+        baseline_kw, baseline_share = self.baseline()
+        peaks = self.peaks(1)
+        total = self.total_kwh()
+        return {
+            "room": self.history.room_id,
+            "start": str(self.local_starts[0]) if len(self.starts) else None,
+            "end": str(self.local_starts[-1] + np.timedelta64(self.window, 's')) if len(self.starts) else None,
+            "samples": len(self.history),
+            "covered_hours": self.covered_hours(),
+            "kwh": total,
+            "price": self.price,
+            "cost": total * self.price,
+            "peak_kw": float(peaks["demand_kw"][0]) if len(peaks["demand_kw"]) else 0.0,
+            "peak_start": str(peaks["start"][0]) if len(peaks["start"]) else None,
+            "baseline_kw": baseline_kw,
+            "baseline_share": baseline_share,
+        }
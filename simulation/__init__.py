@@ -0,0 +1,22 @@
+import importlib.util
+import os
+import sys
+
+from .clock import AcceleratedClock
+from .firebase import FakeRealtimeDatabase
+from .pzem import ReplayProfile, SyntheticProfile, VirtualPzem, VirtualRtuBus
+from .relay import FakeRelay
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONTROLLER_FILE = os.path.join(ROOT, "RPI4 iPecs Code Final.py")
+
+
+def load_ipecs():
+    # The controller lives in a script whose name has spaces, so it is loaded by path.
+    # The module is cached so every caller shares the same classes and exceptions.
+    if "ipecs" not in sys.modules:
+        spec = importlib.util.spec_from_file_location("ipecs", CONTROLLER_FILE)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["ipecs"] = module
+        spec.loader.exec_module(module)
+    return sys.modules["ipecs"]
@@ -0,0 +1,155 @@
+import argparse
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from . import (AcceleratedClock, FakeRealtimeDatabase, FakeRelay, ReplayProfile, SyntheticProfile,
+               VirtualPzem, VirtualRtuBus, load_ipecs, ROOT)
+
+
+def build_simulation(ipecs, args):
+    clock = AcceleratedClock(args.speed)
+    room_ids = [f"Room-{index + 1}" for index in range(args.rooms)]
+
+    def new_database():
+        database = FakeRealtimeDatabase(clock=clock, latency=args.firebase_latency, unavailable_error=ipecs.FirebaseUnavailableError)
+        database.write('/Rooms', {
+            room_id: {"CurrentCredit": args.credit, "ElectricityPrice": args.price, "CreditCriticalLevel": args.critical_level}
+            for room_id in room_ids
+        })
+        if args.offline_seconds > 0:
+            # Boot without connectivity, the controller has to meter from local state
+            database.set_online(False)
+            threading.Timer(args.offline_seconds, database.set_online, (True,)).start()
+        return database
+
+    def new_firebase_manager():
+        return ipecs.FirebaseManager(None, None, database=new_database(), clock=clock)
+
+    buses = {}
+    relays = {}
+    meters = {}
+    room_configs = []
+    for index, room_id in enumerate(room_ids):
+        port = f"/dev/ttyVIRT{index // args.rooms_per_port}"
+        slave_id = index % args.rooms_per_port + 1
+        relay_pin = 100 + index
+        if port not in buses:
+            buses[port] = VirtualRtuBus(port, clock, ipecs.ModbusTimeout)
+        relays[relay_pin] = FakeRelay(relay_pin, clock)
+        if args.profile == 'replay':
+            profile = ReplayProfile(args.replay_file, offset=index * 97)
+        else:
+            profile = SyntheticProfile(seed=index)
+        meter = VirtualPzem(profile, clock, relays[relay_pin])
+        meter.dead = index < args.dead_meters
+        buses[port].add_meter(slave_id, meter)
+        meters[room_id] = meter
+        room_configs.append({"room_id": room_id, "relay_pin": relay_pin, "port": port, "slave_id": slave_id})
+
+    # Split, the sync process builds its own database stand-in and this process
+    # cannot see it, the summary then leaves the remote figures out
+    firebase_manager = None if args.processes == 'split' else new_firebase_manager()
+    database = firebase_manager.database if firebase_manager is not None else None
+    controller = ipecs.ElectricityController(
+        rooms=room_configs,
+        firebase_mode=args.firebase_mode,
+        billing_mode=args.billing_mode,
+        sample_interval=args.sample_interval,
+        min_sample_interval=args.min_sample_interval,
+        max_run_seconds=args.max_run_seconds,
+        firebase_layout=args.firebase_layout,
+        move_legacy_history=args.move_legacy_history,
+        data_dir=args.data_dir,
+        firebase_manager=firebase_manager,
+        session_factory=lambda port: buses[port],
+        relay_factory=lambda pin: relays[pin],
+        clock=clock,
+        metrics_port=args.metrics_port,
+        pipeline_capacity=args.pipeline_capacity,
+        pipeline_batch=args.pipeline_batch,
+        processes=args.processes,
+        firebase_factory=new_firebase_manager,
+        storage_mode=args.storage_mode,
+        codec=args.codec,
+    )
+    return clock, database, buses, meters, controller
+
+
+def summarize(args, clock, database, buses, meters, controller):
+    rooms = {}
+    for room_id, room in controller.rooms.items():
+        remote = (database.read(f'/Rooms/{room_id}') or {}) if database is not None else {}
+        rooms[room_id] = {
+            "meter_kWh": meters[room_id].energy_wh / 1000,
+            "recorded_kWh": sum(room.room_state.power_series.values),
+            "stored_samples": len(room.room_state.power_series),
+            "local_credit": room.room_state.get("CurrentCredit"),
+            "remote_credit": remote.get("CurrentCredit"),
+            "relay_writes": room.relay.writes,
+            "relay_transitions": len(room.relay.transitions),
+        }
+    return {
+        "speed": args.speed,
+        "simulated_seconds": clock.elapsed(),
+        "throughput": controller.rooms_throughput(),
+        "bus_requests": sum(bus.requests for bus in buses.values()),
+        "bus_timeouts": sum(bus.timeouts for bus in buses.values()),
+        "firebase_requests": database.requests if database is not None else None,
+        "firebase_bytes_sent": database.bytes_sent if database is not None else None,
+        "firebase_connected": controller.firebase_manager.connected.is_set() if database is not None else None,
+        "time_to_first_sample": controller.first_sample_seconds,
+        "pipeline_dropped": controller.pipeline.dropped,
+        "pipeline_max_depth": controller.pipeline.max_depth,
+        "rooms": rooms,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the iPecs controller against virtual meters, relays and Firebase")
+    parser.add_argument('--rooms', type=int, default=4)
+    parser.add_argument('--rooms-per-port', type=int, default=4)
+    parser.add_argument('--dead-meters', type=int, default=0, help="number of meters that never answer")
+    parser.add_argument('--profile', choices=['replay', 'synthetic'], default='replay')
+    parser.add_argument('--replay-file', default=os.path.join(ROOT, 'TestJson.json'))
+    parser.add_argument('--speed', type=float, default=1.0, help="simulated seconds per real second")
+    parser.add_argument('--duration', type=float, default=30.0, help="real seconds to run")
+    parser.add_argument('--sample-interval', type=float, default=1.0)
+    parser.add_argument('--min-sample-interval', type=float, default=0.25)
+    parser.add_argument('--max-run-seconds', type=float, default=60.0, help="longest flat run stored as one sample, 0 stores every reading")
+    parser.add_argument('--pipeline-capacity', type=int, default=1024, help="readings queued between acquisition and billing")
+    parser.add_argument('--pipeline-batch', type=int, default=64, help="most readings billed per batch")
+    parser.add_argument('--processes', choices=['single', 'split'], default='single', help="split runs Firebase sync in its own process")
+    parser.add_argument('--firebase-mode', choices=['listen', 'poll'], default='listen')
+    parser.add_argument('--firebase-layout', choices=['partitioned', 'legacy'], default='partitioned')
+    parser.add_argument('--move-legacy-history', action='store_true', help="move a legacy Rooms/<room>/PowerConsumption node into the partitioned layout")
+    parser.add_argument('--firebase-latency', type=float, default=0.05)
+    parser.add_argument('--offline-seconds', type=float, default=0.0, help="real seconds Firebase is unreachable after start")
+    parser.add_argument('--billing-mode', choices=['energy', 'power'], default='power')
+    parser.add_argument('--credit', type=float, default=100.0)
+    parser.add_argument('--price', type=float, default=10.0)
+    parser.add_argument('--critical-level', type=float, default=10.0)
+    parser.add_argument('--storage-mode', choices=['log', 'sqlite', 'json'], default='log', help="local storage of every room, json holds a single room")
+    parser.add_argument('--codec', default='json-compact', help="codec of the local files, e.g. msgpack+zstd")
+    parser.add_argument('--data-dir', default=None, help="local storage directory, a temporary one by default")
+    parser.add_argument('--metrics-port', type=int, default=None, help="serve the controller's Prometheus metrics on this port")
+    parser.add_argument('--verbose', action='store_true', help="keep the controller's per-sample prints")
+    args = parser.parse_args()
+    if args.data_dir is None:
+        args.data_dir = tempfile.mkdtemp(prefix='ipecs-sim-')
+
+    ipecs = load_ipecs()
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    with output:
+        clock, database, buses, meters, controller = build_simulation(ipecs, args)
+        controller.run(daemon=True)
+        time.sleep(args.duration)
+        summary = summarize(args, clock, database, buses, meters, controller)
+    print(json.dumps(summary, indent=4))
+
+
+if __name__ == "__main__":
+    main()
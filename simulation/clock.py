@@ -0,0 +1,26 @@
+import time
+
+
+class AcceleratedClock:
+    # Drop-in for the controller's SystemClock where simulated time runs `speed`
+    # times faster than real time, starting from start_time (now by default)
+    def __init__(self, speed=1.0, start_time=None):
+        self.speed = speed
+        self.real_start = time.monotonic()
+        self.wall_start = time.time() if start_time is None else start_time
+
+    def elapsed(self):
+        return (time.monotonic() - self.real_start) * self.speed
+
+    def time(self):
+        return self.wall_start + self.elapsed()
+
+    def monotonic(self):
+        return self.elapsed()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    def wait(self, condition, seconds=None):
+        return condition.wait(None if seconds is None else seconds / self.speed)
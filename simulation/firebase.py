@@ -0,0 +1,239 @@
+import copy
+import hashlib
+import json
+import queue
+import threading
+from collections import OrderedDict
+
+
+class Event:
+    def __init__(self, event_type, path, data):
+        self.event_type = event_type
+        self.path = path
+        self.data = data
+
+
+class ListenerRegistration:
+    def __init__(self, database, path, callback):
+        self.database = database
+        self.path = path
+        self.callback = callback
+        self.last_value = None
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self.database.remove_listener(self)
+
+
+class FakeReference:
+    def __init__(self, database, path):
+        self.database = database
+        self.path = '/' + '/'.join(database.split(path))
+
+    @property
+    def key(self):
+        parts = self.database.split(self.path)
+        return parts[-1] if parts else None
+
+    def child(self, path):
+        return FakeReference(self.database, self.path.rstrip('/') + '/' + path)
+
+    def get(self, etag=False):
+        self.database.round_trip(None)
+        value = self.database.read(self.path)
+        if etag:
+            return value, self.database.etag(value)
+        return value
+
+    def set_if_unchanged(self, expected_etag, value):
+        # Compare-and-set in one round trip, returns (success, value now, its etag)
+        self.database.round_trip(value)
+        with self.database.lock:
+            current = self.database.read(self.path)
+            if self.database.etag(current) != expected_etag:
+                return False, current, self.database.etag(current)
+            self.database.write(self.path, value)
+            return True, value, self.database.etag(value)
+
+    def set(self, value):
+        self.database.round_trip(value)
+        self.database.write(self.path, value)
+
+    def update(self, value):
+        if not isinstance(value, dict) or not value:
+            raise ValueError("Value argument must be a non-empty dictionary.")
+        self.database.round_trip(value)
+        self.database.write_many(self.path, value)
+
+    def delete(self):
+        self.set(None)
+
+    def transaction(self, transaction_update):
+        # Applied atomically under the database lock, the SDK retries on conflicts instead
+        self.database.round_trip(None)
+        with self.database.lock:
+            new_value = transaction_update(self.database.read(self.path))
+            self.database.write(self.path, new_value)
+        return new_value
+
+    def listen(self, callback):
+        # The SDK opens the stream with a request, so listening fails offline too
+        self.database.round_trip(None)
+        return self.database.add_listener(self.path, callback)
+
+    def order_by_key(self):
+        return FakeQuery(self)
+
+
+class FakeQuery:
+    # order_by_key() query with start_at, end_at and limit_to_first, get() returns the
+    # node's matching children in key order like the SDK's OrderedDict
+    def __init__(self, reference):
+        self.reference = reference
+        self.start = None
+        self.end = None
+        self.limit = None
+
+    def start_at(self, start):
+        self.start = start
+        return self
+
+    def end_at(self, end):
+        self.end = end
+        return self
+
+    def limit_to_first(self, limit):
+        self.limit = limit
+        return self
+
+    def get(self):
+        database = self.reference.database
+        database.round_trip(None)
+        value = database.read(self.reference.path)
+        if not isinstance(value, dict):
+            return OrderedDict()
+        keys = sorted(key for key in value if (self.start is None or key >= self.start) and (self.end is None or key <= self.end))
+        if self.limit is not None:
+            keys = keys[:self.limit]
+        return OrderedDict((key, value[key]) for key in keys)
+
+
+class FakeRealtimeDatabase:
+    # In-process stand-in for the Admin SDK's db module. reference(path) returns a
+    # reference with get/set/set_if_unchanged/update/child/delete/transaction/listen/order_by_key over a JSON tree.
+    # update() takes multi-path keys like the real API. Listeners get a 'put' event at
+    # '/' when registered and after every change to their node, delivered from a
+    # dispatcher thread like the SDK's streaming listeners. Every request waits
+    # `latency` seconds on the simulation clock and is counted with its payload size.
+    # set_online(False) makes every request raise unavailable_error.
+    def __init__(self, data=None, clock=None, latency=0.0, unavailable_error=ConnectionError):
+        self.data = copy.deepcopy(data) if data is not None else {}
+        self.clock = clock
+        self.latency = latency
+        self.unavailable_error = unavailable_error
+        self.online = True
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.events = queue.Queue()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.dispatcher = threading.Thread(target=self.dispatch_events, daemon=True)
+        self.dispatcher.start()
+
+    def reference(self, path='/'):
+        return FakeReference(self, path)
+
+    def set_online(self, online):
+        self.online = online
+
+    def split(self, path):
+        return [part for part in path.split('/') if part]
+
+    def etag(self, value):
+        # Opaque like the real ETag header, equal values give equal etags
+        return hashlib.md5(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+    def round_trip(self, payload):
+        if not self.online:
+            raise self.unavailable_error("Simulated network outage")
+        with self.lock:
+            self.requests += 1
+            if payload is not None:
+                self.bytes_sent += len(json.dumps(payload))
+        if self.latency and self.clock is not None:
+            self.clock.sleep(self.latency)
+
+    def read(self, path):
+        with self.lock:
+            node = self.data
+            for part in self.split(path):
+                if not isinstance(node, dict) or part not in node:
+                    return None
+                node = node[part]
+            return copy.deepcopy(node)
+
+    def write(self, path, value):
+        with self.lock:
+            self.write_node(self.split(path), value)
+            self.notify()
+
+    def write_many(self, path, values):
+        with self.lock:
+            base = self.split(path)
+            for key, value in values.items():
+                self.write_node(base + self.split(key), value)
+            self.notify()
+
+    def write_node(self, parts, value):
+        if not parts:
+            self.data = copy.deepcopy(value) if isinstance(value, dict) else {}
+            return
+        parents = [self.data]
+        node = self.data
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                if value is None:
+                    return
+                node[part] = {}
+            node = node[part]
+            parents.append(node)
+        if value is None:
+            node.pop(parts[-1], None)
+            # Like the real database, emptied parents disappear too
+            for depth in range(len(parts) - 1, 0, -1):
+                if parents[depth]:
+                    break
+                parents[depth - 1].pop(parts[depth - 1], None)
+        else:
+            node[parts[-1]] = copy.deepcopy(value)
+
+    def add_listener(self, path, callback):
+        registration = ListenerRegistration(self, path, callback)
+        with self.lock:
+            self.listeners.append(registration)
+            registration.last_value = self.read(path)
+            self.events.put((registration, registration.last_value))
+        return registration
+
+    def remove_listener(self, registration):
+        with self.lock:
+            if registration in self.listeners:
+                self.listeners.remove(registration)
+
+    def notify(self):
+        for registration in self.listeners:
+            value = self.read(registration.path)
+            if value != registration.last_value:
+                registration.last_value = value
+                self.events.put((registration, value))
+
+    def dispatch_events(self):
+        while True:
+            registration, value = self.events.get()
+            if registration.closed:
+                continue
+            try:
+                registration.callback(Event('put', '/', value))
+            except Exception as e:
+                print("Simulated Listener Error: ", e)
@@ -0,0 +1,118 @@
+import json
+import math
+import random
+import threading
+
+
+class ReplayProfile:
+    # Replays a recorded PowerConsumption history (TestJson.json shape) one stored
+    # sample per simulated second. Each stored value is one second of energy in kWh,
+    # so the load in watts is kWh * 3,600,000. offset staggers rooms sharing a file.
+    def __init__(self, json_file, room_id="Room-1", offset=0):
+        with open(json_file, 'r') as f:
+            power_data = json.load(f)["Rooms"][room_id]["PowerConsumption"]
+        self.watts = [value * 3600000 for value in power_data.values()] or [0]
+        self.offset = offset
+
+    def watts_at(self, elapsed):
+        return self.watts[(int(elapsed) + self.offset) % len(self.watts)]
+
+
+class SyntheticProfile:
+    # An idle baseline, a slow daily-style swing and an appliance that switches on
+    # for one appliance_period in three, with +/- noise on every reading
+    def __init__(self, base_watts=5, swing_watts=300, period=86400, appliance_watts=1500, appliance_period=600, noise=0.02, seed=None):
+        self.base_watts = base_watts
+        self.swing_watts = swing_watts
+        self.period = period
+        self.appliance_watts = appliance_watts
+        self.appliance_period = appliance_period
+        self.noise = noise
+        self.random = random.Random(seed)
+
+    def watts_at(self, elapsed):
+        watts = self.base_watts + self.swing_watts * (1 + math.sin(2 * math.pi * elapsed / self.period)) / 2
+        if int(elapsed // self.appliance_period) % 3 == 0:
+            watts += self.appliance_watts
+        return watts * (1 + self.random.uniform(-self.noise, self.noise))
+
+
+class VirtualPzem:
+    # PZEM-004T v3 register model. The profile's load is integrated second by second
+    # into the meter's own cumulative energy register, and nothing flows while the
+    # room's relay is off. registers() answers the 10-register input read with the
+    # same raw fixed-point layout as the real meter.
+    ENERGY_WRAP_WH = 10000000
+
+    def __init__(self, profile, clock, relay=None, voltage=230.0, frequency=60.0, power_factor=0.95, energy_wh=0.0):
+        self.profile = profile
+        self.clock = clock
+        self.relay = relay
+        self.voltage = voltage
+        self.frequency = frequency
+        self.power_factor = power_factor
+        self.energy_wh = energy_wh
+        self.integrated_until = clock.monotonic()
+        self.dead = False
+
+    def load_watts(self, elapsed):
+        if self.relay is not None and not self.relay.is_lit:
+            return 0
+        return self.profile.watts_at(elapsed)
+
+    def integrate(self, now):
+        while self.integrated_until < now:
+            step_end = min(math.floor(self.integrated_until) + 1, now)
+            self.energy_wh += self.load_watts(self.integrated_until) * (step_end - self.integrated_until) / 3600
+            self.integrated_until = step_end
+
+    def registers(self):
+        now = self.clock.monotonic()
+        self.integrate(now)
+        watts = self.load_watts(now)
+        current = round(watts / self.voltage * 1000)
+        power = round(watts * 10)
+        energy = int(self.energy_wh) % self.ENERGY_WRAP_WH
+        return (
+            round(self.voltage * 10),
+            current & 0xFFFF, current >> 16,
+            power & 0xFFFF, power >> 16,
+            energy & 0xFFFF, energy >> 16,
+            round(self.frequency * 10),
+            round(self.power_factor * 100),
+            0,
+        )
+
+
+class VirtualRtuBus:
+    # Stands in for the controller's RtuSession on one port. Each read goes to the
+    # VirtualPzem at that slave id after the RS-485 transfer time at `baudrate`, on
+    # the simulation clock. A missing or dead slave costs the full timeout and
+    # raises timeout_error, like modbus_tk does for a meter that never answers.
+    def __init__(self, port, clock, timeout_error, baudrate=9600, processing_delay=0.02, timeout=2.0):
+        self.port = port
+        self.clock = clock
+        self.timeout_error = timeout_error
+        self.baudrate = baudrate
+        self.processing_delay = processing_delay
+        self.timeout = timeout
+        self.meters = {}
+        self.lock = threading.Lock()
+        self.reopen_count = 0
+        self.requests = 0
+        self.timeouts = 0
+
+    def add_meter(self, slave_id, meter):
+        self.meters[slave_id] = meter
+
+    def execute(self, slave_id, function_code, address, quantity, timeout=None):
+        with self.lock:
+            self.requests += 1
+            meter = self.meters.get(slave_id)
+            if meter is None or meter.dead:
+                self.timeouts += 1
+                self.clock.sleep(timeout or self.timeout)
+                raise self.timeout_error("Response length is invalid 0")
+            # 8 byte request and 5 + 2 * quantity byte response, 10 bits per byte
+            self.clock.sleep((8 + 5 + 2 * quantity) * 10 / self.baudrate + self.processing_delay)
+            return meter.registers()[address:address + quantity]
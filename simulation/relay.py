@@ -0,0 +1,21 @@
+class FakeRelay:
+    # gpiozero.LED stand-in. writes counts every on()/off() call, transitions only
+    # the calls that actually changed the relay state.
+    def __init__(self, pin, clock=None):
+        self.pin = pin
+        self.clock = clock
+        self.is_lit = False
+        self.writes = 0
+        self.transitions = []
+
+    def set_state(self, state):
+        self.writes += 1
+        if state != self.is_lit:
+            self.is_lit = state
+            self.transitions.append((self.clock.time() if self.clock is not None else None, state))
+
+    def on(self):
+        self.set_state(True)
+
+    def off(self):
+        self.set_state(False)
@@ -0,0 +1,31 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from simulation import load_ipecs
+
+
+class ManualClock:
+    # SystemClock stand-in whose time only moves with advance(). wait() gives other
+    # threads a moment of real time, so they see each advance.
+    def __init__(self, start=1700000000.0):
+        self.wall_start = start
+        self.now = 0.0
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def time(self):
+        return self.wall_start + self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+    def wait(self, condition, seconds=None):
+        return condition.wait(0.01)
@@ -0,0 +1,82 @@
+import unittest
+
+from .helpers import ManualClock, load_ipecs
+
+ipecs = load_ipecs()
+
+REGISTERS = [2300, 4348, 0, 10000, 0, 1500, 0, 500, 100, 0]
+
+
+class ExceptionReply(Exception):
+    # Stands in for modbus_tk's ModbusError, which pzem_sensor_data_read does not catch
+    pass
+
+
+class FakeSession:
+    # Answers every slave with REGISTERS except those in failing, which raise
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+
+    def execute(self, slave_id, function_code, address, count, timeout=None):
+        if slave_id in self.failing:
+            raise ExceptionReply("Exception code = 2")
+        return list(REGISTERS)
+
+
+class BusSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = ManualClock()
+        self.session = FakeSession(failing=[2])
+        self.readings = []
+        self.scheduler = ipecs.BusScheduler(self.session, self.on_reading, backoff_max=60, clock=self.clock)
+        for slave_id in (1, 2):
+            meter = ipecs.Pzem004T("/dev/ttyUSB0", slave_id, session=self.session)
+            self.scheduler.add_meter(meter, poll_interval=1)
+
+    def on_reading(self, meter, measurement):
+        self.readings.append(meter.slave_id)
+
+    def poll_for(self, seconds):
+        end = self.clock.monotonic() + seconds
+        while self.clock.monotonic() < end:
+            wait = self.scheduler.poll_once()
+            if wait > 0:
+                self.clock.sleep(wait)
+
+    def test_exception_reply_backs_off_meter(self):
+        self.poll_for(20)
+        failing = self.scheduler.meters[1]
+        self.assertGreater(failing["failures"], 1)
+        self.assertGreater(failing["next_poll"], self.clock.monotonic())
+        # The answering meter keeps its 1 s interval
+        self.assertGreaterEqual(self.readings.count(1), 19)
+        self.assertNotIn(2, self.readings)
+
+    def test_meter_recovers_after_exception_reply(self):
+        self.poll_for(5)
+        self.session.failing.clear()
+        self.poll_for(61)
+        self.assertEqual(self.scheduler.meters[1]["failures"], 0)
+        self.assertIn(2, self.readings)
+
+
+class FakeMaster:
+    pass
+
+
+class ModbusTimeoutTest(unittest.TestCase):
+    def test_timeout_is_an_empty_response(self):
+        master = FakeMaster()
+        master.last_response_length = 0
+        self.assertTrue(ipecs.is_modbus_timeout(ipecs.ModbusInvalidResponseError("no reply"), master))
+        master.last_response_length = 2
+        self.assertFalse(ipecs.is_modbus_timeout(ipecs.ModbusInvalidResponseError("Response length is invalid 0"), master))
+
+    def test_error_text_without_response_length(self):
+        master = FakeMaster()
+        self.assertTrue(ipecs.is_modbus_timeout(ipecs.ModbusInvalidResponseError("Response length is invalid 0"), master))
+        self.assertFalse(ipecs.is_modbus_timeout(ipecs.ModbusInvalidResponseError("Invalid CRC in response"), master))
+
+
+if __name__ == '__main__':
+    unittest.main()
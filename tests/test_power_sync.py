@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from .helpers import ManualClock, load_ipecs
+
+ipecs = load_ipecs()
+
+
+class FakeFirebaseManager:
+    def __init__(self):
+        self.updates = []
+
+    def update_firebase_data(self, payload, room_id=None):
+        self.updates.append(payload)
+        return True
+
+
+class CountingSync(ipecs.PowerConsumptionSync):
+    saves = 0
+
+    def save_watermark(self, last_timestamp):
+        self.saves += 1
+        super().save_watermark(last_timestamp)
+
+
+class PowerSyncWatermarkTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.clock = ManualClock()
+        self.watermark_file = os.path.join(self.data_dir, 'watermark.json')
+        manager = ipecs.LocalDataManager(os.path.join(self.data_dir, 'TestJson.json'), os.path.join(self.data_dir, 'TestJson_backup.json'), storage_mode='log')
+        self.room_state = ipecs.RoomState(manager, clock=self.clock)
+        self.firebase_manager = FakeFirebaseManager()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def power_sync(self):
+        return CountingSync(self.firebase_manager, self.room_state, self.watermark_file, clock=self.clock, watermark_interval=60)
+
+    def sync_for(self, power_sync, seconds):
+        # One sample a second, a sync every 2 s
+        for _ in range(seconds // 2):
+            for _ in range(2):
+                self.room_state.add_power_consumption(self.clock.time(), 0.0001).result()
+                self.clock.advance(1)
+            self.assertTrue(power_sync.sync())
+
+    def test_watermark_saved_once_per_interval(self):
+        power_sync = self.power_sync()
+        self.sync_for(power_sync, 300)
+        self.assertEqual(len(self.firebase_manager.updates), 150)
+        self.assertEqual(power_sync.saves, 5)
+        # An idle sync saves the cursor once the interval is up
+        self.clock.advance(60)
+        power_sync.sync()
+        self.assertEqual(power_sync.saves, 6)
+        self.assertEqual(ipecs.PowerConsumptionSync.read_watermark(self.watermark_file)[1], self.clock.time() - 61)
+
+    def test_restart_resumes_from_saved_watermark(self):
+        power_sync = self.power_sync()
+        self.sync_for(power_sync, 90)
+        saved_position = ipecs.PowerConsumptionSync.read_watermark(self.watermark_file)[0]
+        self.assertLess(saved_position, power_sync.position)
+        restarted = self.power_sync()
+        self.assertEqual(restarted.position, saved_position)
+        # Only the samples after the saved watermark are sent again
+        samples, _ = self.room_state.samples_since(restarted.position)
+        self.assertEqual(len(samples), power_sync.position - saved_position)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import time
+import unittest
+
+from simulation import FakeRelay
+
+from .helpers import ManualClock, load_ipecs
+
+ipecs = load_ipecs()
+
+# 1 kW at 10 per kWh uses 1 credit every 360 s
+POWER = 1000
+PRICE = 10
+
+
+class RelayControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = ManualClock()
+        self.relay = FakeRelay(17)
+        self.controller = ipecs.RelayController(self.relay, "Room-1", clock=self.clock)
+
+    def wait_for_relay(self, on, timeout=1.0):
+        deadline = time.monotonic() + timeout
+        while self.relay.is_lit != on and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.relay.is_lit
+
+    def test_cutoff_counts_from_billed_reading(self):
+        self.controller.update(1, POWER, PRICE, as_of=0)
+        self.clock.advance(100)
+        # The same balance again must not push the cutoff later
+        self.controller.update(1, POWER, PRICE, as_of=0)
+        self.assertAlmostEqual(self.controller.cutoff_at, 360)
+
+    def test_top_up_after_long_cutoff_is_not_cut_at_once(self):
+        self.controller.update(1, POWER, PRICE, as_of=0)
+        self.controller.update(0, POWER, PRICE, as_of=300)
+        self.assertFalse(self.relay.is_lit)
+        # Off for hours, the last billed reading is from before the cutoff
+        self.clock.advance(10000)
+        self.controller.update(5, POWER, PRICE, as_of=300)
+        self.assertTrue(self.relay.is_lit)
+        self.assertAlmostEqual(self.controller.cutoff_at, 10000 + 5 * 360)
+        self.assertEqual([state for _, state in self.relay.transitions], [True, False, True])
+
+    def test_predicted_cutoff_is_rescheduled_after_reconnect(self):
+        self.controller.start()
+        self.controller.update(5, POWER, PRICE, as_of=0)
+        self.clock.advance(5 * 360 + 1)
+        self.assertFalse(self.wait_for_relay(False))
+        # Billing has not caught up yet, the same balance reconnects the relay
+        self.controller.update(5, POWER, PRICE, as_of=0)
+        self.assertTrue(self.relay.is_lit)
+        self.assertAlmostEqual(self.controller.cutoff_at, 5 * 360 + 1 + 5 * 360)
+
+
+if __name__ == "__main__":
+    unittest.main()
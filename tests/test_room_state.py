@@ -0,0 +1,65 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from .helpers import ManualClock, load_ipecs
+
+ipecs = load_ipecs()
+
+DAY = 86400
+
+
+class RoomStateHistoryTest(unittest.TestCase):
+    # Three days of one sample a minute, the watermark in the last day
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.clock = ManualClock()
+        self.midnight = datetime(2026, 3, 2).timestamp()
+        self.samples = [(self.midnight + minute * 60, 0.001) for minute in range(3 * 1440)]
+        self.watermark_file = os.path.join(self.data_dir, 'watermark.json')
+        self.watermark = self.samples[2 * 1440 + 600]
+        with open(self.watermark_file, 'w') as f:
+            json.dump({"Position": 2 * 1440 + 601, "LastTimestamp": self.watermark[0]}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def manager(self, storage_mode):
+        manager = ipecs.LocalDataManager(os.path.join(self.data_dir, 'TestJson.json'), os.path.join(self.data_dir, 'TestJson_backup.json'), storage_mode=storage_mode)
+        if storage_mode == 'log':
+            # Several segments, the older ones are skipped without being read
+            manager.sample_log.segment_size = 1000 * manager.sample_log.RECORD.size
+        return manager
+
+    def check_history_since(self, storage_mode):
+        manager = self.manager(storage_mode)
+        manager.append_power_consumption(self.samples)
+        manager.commit_due()
+        since = ipecs.PowerConsumptionSync.history_start(self.watermark_file)
+        self.assertEqual(since, self.midnight + 2 * DAY)
+        full = ipecs.RoomState(manager, clock=self.clock)
+        partial = ipecs.RoomState(manager, clock=self.clock, history_since=since)
+        self.assertEqual(len(partial.power_series.timestamps), 1440)
+        self.assertEqual(partial.power_series.offset, 2 * 1440)
+        self.assertEqual(partial.power_series.timestamps[0], since)
+        # Positions and the day's totals match the fully loaded history
+        self.assertEqual(len(partial.power_series), len(full.power_series))
+        position = partial.find_sample_position(self.watermark[0], 0)
+        self.assertEqual(position, full.find_sample_position(self.watermark[0], 0))
+        self.assertEqual(partial.samples_since(position), full.samples_since(position))
+        self.assertAlmostEqual(partial.total_between(since, since + DAY), full.total_between(since, since + DAY))
+        # Firebase retention still starts from the oldest sample on disk
+        self.assertEqual(partial.oldest_sample(), self.midnight)
+
+    def test_log_loads_history_since(self):
+        self.check_history_since('log')
+
+    def test_sqlite_loads_history_since(self):
+        self.check_history_since('sqlite')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+from .helpers import load_ipecs
+
+ipecs = load_ipecs()
+
+
+class SampleRingTest(unittest.TestCase):
+    def setUp(self):
+        self.ring = ipecs.SampleRing(capacity=8)
+
+    def tearDown(self):
+        self.ring.memory.close()
+        self.ring.unlink()
+
+    def records(self, start, count):
+        return [(1, position, 1700000000.0 + position, 0.001) for position in range(start, start + count)]
+
+    def test_records_wrap_around(self):
+        taken = []
+        for start in range(0, 40, 5):
+            self.assertEqual(self.ring.put(self.records(start, 5)), 5)
+            taken += self.ring.take()
+        self.assertEqual(taken, self.records(0, 40))
+
+    def test_full_ring_keeps_untaken_records(self):
+        self.assertEqual(self.ring.put(self.records(0, 10)), 8)
+        self.assertEqual(self.ring.put(self.records(8, 2)), 0)
+        self.assertEqual(self.ring.take(limit=3), self.records(0, 3))
+        self.assertEqual(self.ring.put(self.records(8, 2)), 2)
+        self.assertEqual(self.ring.take(), self.records(3, 7))
+
+    def test_slot_with_stale_record_is_not_taken(self):
+        self.ring.put(self.records(0, 2))
+        # The new sequence is visible but the second record's bytes are not yet
+        offset = self.ring.slot_offset(1)
+        complete = bytes(self.ring.memory.buf[offset:offset + self.ring.RECORD.size])
+        self.ring.memory.buf[offset:offset + self.ring.RECORD.size] = bytes(self.ring.RECORD.size)
+        self.assertEqual(self.ring.take(), self.records(0, 1))
+        self.assertEqual(self.ring.depth(), 1)
+        self.ring.memory.buf[offset:offset + self.ring.RECORD.size] = complete
+        self.assertEqual(self.ring.take(), self.records(1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import time
+import unittest
+
+import numpy as np
+
+from .helpers import ROOT  # noqa: F401 puts the repo on sys.path
+from reports import UsageHistory, UsageReport
+
+KWH_PER_UNIT = 1e-7
+
+
+def history(timestamps, units, fields=None):
+    return UsageHistory("Room-1", np.asarray(timestamps, dtype=np.float64), np.asarray(units, dtype=np.int64), fields or {}, KWH_PER_UNIT)
+
+
+def reference_windows(report, timestamps, units):
+    # Spreads every sample over its span one window at a time
+    window = report.window
+    energy = np.zeros(len(report.starts))
+    coverage = np.zeros(len(report.starts))
+    energy[int(np.ceil(timestamps[0] / window)) - 1 - report.starts[0] // window] += units[0] * KWH_PER_UNIT
+    for i in range(1, len(timestamps)):
+        a, b = timestamps[i - 1], timestamps[i]
+        for w, start in enumerate(report.starts):
+            lo, hi = max(a, start), min(b, start + window)
+            if hi > lo:
+                energy[w] += units[i] * KWH_PER_UNIT * (hi - lo) / (b - a)
+                if b - a <= report.max_gap:
+                    coverage[w] += hi - lo
+    return energy, coverage
+
+
+class UsageReportTest(unittest.TestCase):
+    def setUp(self):
+        self.midnight = time.mktime((2026, 3, 2, 0, 0, 0, 0, 0, -1))
+
+    def test_windows_match_per_sample_reference(self):
+        rng = np.random.default_rng(3)
+        steps = rng.choice([1, 5, 60, 700, 5000], size=3000, p=[.5, .2, .2, .08, .02]).astype(float)
+        timestamps = self.midnight + 450 + np.cumsum(steps)
+        units = rng.integers(1, 1000, len(timestamps))
+        report = UsageReport(history(timestamps, units), window=900, max_gap=3600)
+        energy, coverage = reference_windows(report, timestamps, units)
+        np.testing.assert_allclose(report.energy, energy, atol=1e-12)
+        np.testing.assert_allclose(report.coverage, coverage, atol=1e-6)
+        self.assertAlmostEqual(report.total_kwh(), units.sum() * KWH_PER_UNIT)
+
+    def test_partly_covered_windows_keep_full_demand(self):
+        # A constant 1 kW for 3 h starting mid-window, one 1 Wh sample every 3.6 s
+        timestamps = self.midnight + 450 + np.arange(0, 3 * 3600 + 0.1, 3.6)
+        report = UsageReport(history(timestamps, np.full(len(timestamps), 10000)))
+        summary = report.summary()
+        self.assertAlmostEqual(summary["baseline_kw"], 1.0, places=6)
+        self.assertAlmostEqual(summary["peak_kw"], 1.0, places=6)
+        np.testing.assert_allclose(report.load_duration()["demand_kw"], 1.0)
+
+    def test_outage_is_not_covered(self):
+        # 100 W in 1 s samples with the meter down from 10:00 to 13:00
+        timestamps = self.midnight + np.concatenate([np.arange(1, 36001), np.arange(46801, 86401)])
+        units = np.full(len(timestamps), round(100 / 3600000 / KWH_PER_UNIT))
+        report = UsageReport(history(timestamps, units))
+        summary = report.summary()
+        self.assertAlmostEqual(summary["covered_hours"], 21, places=2)
+        self.assertAlmostEqual(summary["baseline_kw"], 0.1, places=3)
+        self.assertAlmostEqual(summary["peak_kw"], 0.1, places=3)
+        hourly = report.periods('hour')
+        np.testing.assert_allclose(hourly["covered_hours"][10:13], 0.0)
+        np.testing.assert_allclose(hourly["average_kw"][[0, 9, 13, 23]], 0.1, rtol=1e-2)
+
+
+if __name__ == '__main__':
+    unittest.main()